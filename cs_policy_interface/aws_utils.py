@@ -1,10 +1,20 @@
 # This file is subject to the terms and conditions defined in the file
 # 'LICENSE.txt', which is part of this source code package.
 
+import contextvars
+import hashlib
 import json
+import os
+import random
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from copy import deepcopy
 
 import boto3
+import botocore.session
 import pyotp
 import yaml
 from botocore.exceptions import ClientError
@@ -13,7 +23,295 @@ from configparser import NoOptionError
 from configparser import NoSectionError
 
 
-def get_sts_credentials(credentials):
+CACHEABLE_OPERATION_PREFIXES = ('describe_', 'list_', 'get_')
+NON_CACHEABLE_OPERATIONS = ('get_object', 'get_object_torrent')
+
+# Responses kept per run scope, the least recently used one is dropped first
+OPERATION_CACHE_MAX_SIZE = 2048
+
+_operation_cache = contextvars.ContextVar('aws_operation_cache', default=None)
+
+REGION_FAN_OUT_MAX_WORKERS = 8
+# Upper bound of concurrent region workers per AWS service, across every rule running in the process
+SERVICE_CONCURRENCY_LIMITS = {
+    'default': 8,
+    'iam': 2,
+    'organizations': 2,
+    'sts': 4
+}
+
+_service_semaphores_lock = threading.Lock()
+_service_semaphores = {}
+
+# Maximum number of boto3 clients kept per process, the least recently used one is dropped first
+AWS_CLIENT_POOL_SIZE = 256
+
+_aws_clients_lock = threading.Lock()
+_aws_clients = OrderedDict()
+_aws_sessions = {}
+
+# Requests per second allowed per (account, region, service) at start, adapted on throttling responses
+AWS_RATE_LIMIT = 10.0
+AWS_RATE_LIMIT_MIN = 0.5
+AWS_RATE_LIMIT_MAX = 50.0
+AWS_RATE_LIMIT_BURST = 10
+# Multiplicative decrease on a throttling response, additive increase on a successful request
+AWS_RATE_LIMIT_DECREASE = 0.5
+AWS_RATE_LIMIT_INCREASE = 0.1
+AWS_THROTTLE_MAX_RETRIES = 15
+AWS_BACKOFF_BASE = 1
+AWS_BACKOFF_CAP = 60
+CORESTACK_CONF_PATH = '/etc/corestack/corestack.conf'
+
+# AssumeRole credentials are refreshed this many seconds before they expire
+STS_REFRESH_MARGIN = 300
+# Lifetime assumed for AssumeRole credentials returned without an Expiration
+STS_DEFAULT_DURATION = 900
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+                          'RequestThrottledException', 'RequestLimitExceeded', 'TooManyRequestsException',
+                          'SlowDown', 'ProvisionedThroughputExceededException')
+
+
+class AwsOperationCache(object):
+    """Read-only AWS responses of one run scope, bounded to `max_size` responses"""
+
+    def __init__(self, max_size=OPERATION_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._responses = OrderedDict()
+
+    def get(self, cache_key):
+        with self._lock:
+            response = self._responses.get(cache_key)
+            if response is not None:
+                self._responses.move_to_end(cache_key)
+            return response
+
+    def set(self, cache_key, response):
+        with self._lock:
+            self._responses[cache_key] = response
+            while len(self._responses) > self.max_size:
+                self._responses.popitem(last=False)
+
+
+@contextmanager
+def aws_operation_cache():
+    """Run scope for read-only AWS responses.
+
+    Every describe/list/get call made through `run_aws_operation` inside the scope is fetched once
+    and served from memory afterwards. The cache belongs to the scope: it is kept in a context variable, so
+    runs in other threads get their own, and it is dropped when the scope exits. A nested scope reuses
+    the cache of the enclosing one; worker threads see it when they run in a copy of the context
+    (see `run_for_regions`).
+    """
+    cache = _operation_cache.get()
+    if cache is not None:
+        yield cache
+        return
+    cache = AwsOperationCache()
+    token = _operation_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _operation_cache.reset(token)
+
+
+def get_operation_cache_key(credentials, service_name, operation_name, operation_args, response_key, region_name):
+    if not operation_name.startswith(CACHEABLE_OPERATION_PREFIXES) or operation_name in NON_CACHEABLE_OPERATIONS:
+        return None
+    identity = credentials.get('assume_role_arn') or credentials.get('access_key')
+    return (identity, service_name, operation_name, json.dumps(operation_args, sort_keys=True, default=str),
+            response_key, region_name)
+
+
+def get_service_semaphore(service_name):
+    with _service_semaphores_lock:
+        if service_name not in _service_semaphores:
+            limit = SERVICE_CONCURRENCY_LIMITS.get(service_name, SERVICE_CONCURRENCY_LIMITS['default'])
+            _service_semaphores[service_name] = threading.BoundedSemaphore(limit)
+        return _service_semaphores[service_name]
+
+
+def run_for_regions(regions, region_handler, service_name=None, max_workers=None):
+    """Runs `region_handler(region)` for every region on a bounded thread pool.
+
+    `region_handler` returns the usual `(output, evaluated_resources)` tuple for one region. Results are
+    merged in the order of `regions`, so the shape and ordering match the sequential `for region in regions`
+    loop. If any region fails, the exception of the first failing region (in region order) is raised.
+    """
+    regions = list(regions)
+    if not regions:
+        return list(), 0
+    semaphore = get_service_semaphore(service_name) if service_name else None
+
+    def run_region(region):
+        if semaphore is None:
+            return region_handler(region)
+        with semaphore:
+            return region_handler(region)
+
+    pool = ThreadPoolExecutor(max_workers=min(max_workers or REGION_FAN_OUT_MAX_WORKERS, len(regions)))
+    try:
+        # Each worker runs in a copy of the caller's context, so it shares the caller's `aws_operation_cache`
+        futures = [pool.submit(contextvars.copy_context().run, run_region, region) for region in regions]
+        region_results = [future.result() for future in futures]
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    output = list()
+    evaluated_resources = 0
+    for region_output, region_evaluated_resources in region_results:
+        output.extend(region_output)
+        evaluated_resources += region_evaluated_resources
+    return output, evaluated_resources
+
+
+def get_credential_fingerprint(client_args):
+    """Digest of the credentials of `client_args`, so the client cache never holds secrets in its keys"""
+    credential = '\x00'.join(client_args.get(key) or '' for key in (
+        'aws_access_key_id', 'aws_secret_access_key', 'aws_session_token'))
+    return hashlib.sha256(credential.encode('utf-8')).hexdigest()
+
+
+def get_boto3_session():
+    """boto3 session shared by every client of the process, its botocore loader keeps the service models"""
+    pid = os.getpid()
+    if pid not in _aws_sessions:
+        _aws_sessions[pid] = boto3.session.Session(botocore_session=botocore.session.get_session())
+    return _aws_sessions[pid]
+
+
+def get_aws_client(service_name, **client_args):
+    """Returns a boto3 client shared by every caller with the same credentials, service, region and endpoint.
+
+    Clients are thread safe and keep their HTTP connection pool, so reusing them saves the service model
+    loading, the endpoint resolution and the TLS handshakes of a new client. At most `AWS_CLIENT_POOL_SIZE`
+    clients are kept per process (a forked worker builds its own).
+    """
+    client_key = (os.getpid(), get_credential_fingerprint(client_args), service_name,
+                  client_args.get('region_name'), client_args.get('endpoint_url'))
+    with _aws_clients_lock:
+        client = _aws_clients.get(client_key)
+        if client is not None:
+            _aws_clients.move_to_end(client_key)
+            return client
+        # Creating clients from one session is not thread safe, the lock also serializes that
+        client = get_boto3_session().client(service_name, **client_args)
+        _aws_clients[client_key] = client
+        while len(_aws_clients) > AWS_CLIENT_POOL_SIZE:
+            _aws_clients.popitem(last=False)
+        return client
+
+
+def clear_aws_clients():
+    with _aws_clients_lock:
+        _aws_clients.clear()
+
+
+def is_throttling_error(error):
+    if isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+        return True
+    return "Throttling" in str(error)
+
+
+class TokenBucket(object):
+    """Adaptive token bucket of one (account, region, service)
+
+    Every request takes a token, tokens come back at `rate` per second up to `capacity`. A throttling response
+    halves the rate and empties the bucket, every successful request raises the rate a little again.
+    """
+
+    def __init__(self, rate=AWS_RATE_LIMIT, capacity=AWS_RATE_LIMIT_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self.requests = 0
+        self.throttles = 0
+        self.last_throttle = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.requests += 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(AWS_RATE_LIMIT_MAX, self.rate + AWS_RATE_LIMIT_INCREASE)
+
+    def on_throttle(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(AWS_RATE_LIMIT_MIN, self.rate * AWS_RATE_LIMIT_DECREASE)
+            self._tokens = 0.0
+            self.throttles += 1
+            self.last_throttle = time.time()
+
+    def run(self, request, max_retries=AWS_THROTTLE_MAX_RETRIES):
+        """Returns `request()`, retried with full jitter backoff while AWS throttles it.
+
+        `request` makes one API call and takes its own token.
+        """
+        attempt = 0
+        while True:
+            try:
+                result = request()
+            except Exception as e:
+                if not is_throttling_error(e) or attempt >= max_retries:
+                    raise e
+                self.on_throttle()
+                attempt += 1
+                time.sleep(random.uniform(0, min(AWS_BACKOFF_CAP, AWS_BACKOFF_BASE * 2 ** attempt)))
+                continue
+            self.on_success()
+            return result
+
+    def get_state(self):
+        with self._lock:
+            self._refill()
+            return {"rate": self.rate, "tokens": self._tokens, "capacity": self.capacity,
+                    "requests": self.requests, "throttles": self.throttles, "last_throttle": self.last_throttle}
+
+
+class AwsRateLimiter(object):
+    """Token buckets per (account, region, service), shared by every rule running in the process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = dict()
+
+    def get_bucket(self, account, region_name, service_name):
+        bucket_key = (account, region_name or 'global', service_name)
+        with self._lock:
+            if bucket_key not in self._buckets:
+                self._buckets[bucket_key] = TokenBucket()
+            return self._buckets[bucket_key]
+
+    def get_state(self):
+        with self._lock:
+            buckets = list(self._buckets.items())
+        return {bucket_key: bucket.get_state() for bucket_key, bucket in buckets}
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+aws_rate_limiter = AwsRateLimiter()
+
+
+def assume_role(credentials):
     retry = 5
     sleep_time = 10
     assume_role_args = dict(RoleArn=credentials['assume_role_arn'],
@@ -21,10 +319,10 @@ def get_sts_credentials(credentials):
                             ExternalId=credentials['assume_role_external_id'])
     default_region = credentials.get('assume_role_region', 'us-east-1')
     endpoint = get_custom_endpoint_aws('sts', default_region)
-    conn = boto3.client('sts', aws_access_key_id=credentials['assume_role_access_key'],
-                        aws_secret_access_key=credentials['assume_role_secret_key'],
-                        region_name=default_region,
-                        endpoint_url=endpoint)
+    conn = get_aws_client('sts', aws_access_key_id=credentials['assume_role_access_key'],
+                          aws_secret_access_key=credentials['assume_role_secret_key'],
+                          region_name=default_region,
+                          endpoint_url=endpoint)
     if json.loads(credentials.get('assume_role_mfa_enabled', 'false')):
         assume_role_args['SerialNumber'] = credentials['assume_role_mfa_device_id']
         assume_role_args['TokenCode'] = pyotp.TOTP(credentials['assume_role_mfa_device_secret']).now()
@@ -45,104 +343,242 @@ def get_sts_credentials(credentials):
     return response.get('Credentials', {})
 
 
-def get_results_from_paginator(client, operation_name, operation_args, response_key):
+class StsCredentialCache(object):
+    """Process wide cache of the AssumeRole credentials per (role ARN, external ID)
+
+    Credentials are refreshed `refresh_margin` seconds before their `Expiration`, so rules never start a call with
+    a token about to expire. Concurrent refreshes of one role wait for a single AssumeRole call.
+    """
+
+    def __init__(self, refresh_margin=STS_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._credentials = dict()
+        self._refresh_locks = dict()
+
+    @staticmethod
+    def get_role_key(credentials):
+        return credentials['assume_role_arn'], credentials.get('assume_role_external_id')
+
+    def _get_fresh(self, role_key, expired_access_key):
+        with self._lock:
+            cached = self._credentials.get(role_key)
+        if cached is None or cached[0] - self.refresh_margin <= time.time():
+            return None
+        if expired_access_key and cached[1].get('AccessKeyId') == expired_access_key:
+            return None
+        return cached[1]
+
+    def get(self, credentials, expired_access_key=None):
+        """AssumeRole credentials of the role, `expired_access_key` forces a refresh if it is the cached key"""
+        role_key = self.get_role_key(credentials)
+        sts_credentials = self._get_fresh(role_key, expired_access_key)
+        if sts_credentials is not None:
+            return sts_credentials
+        with self._lock:
+            refresh_lock = self._refresh_locks.setdefault(role_key, threading.Lock())
+        with refresh_lock:
+            # Another thread may have refreshed the role while this one was waiting
+            sts_credentials = self._get_fresh(role_key, expired_access_key)
+            if sts_credentials is not None:
+                return sts_credentials
+            sts_credentials = assume_role(credentials)
+            expiration = sts_credentials.get('Expiration')
+            expires_at = expiration.timestamp() if expiration else time.time() + STS_DEFAULT_DURATION
+            with self._lock:
+                self._credentials[role_key] = (expires_at, sts_credentials)
+            return sts_credentials
+
+    def invalidate(self, role_arn=None):
+        with self._lock:
+            if role_arn is None:
+                self._credentials.clear()
+            else:
+                for role_key in [role_key for role_key in self._credentials if role_key[0] == role_arn]:
+                    self._credentials.pop(role_key)
+
+
+sts_credential_cache = StsCredentialCache()
+
+
+def get_sts_credentials(credentials, expired_access_key=None):
+    return sts_credential_cache.get(credentials, expired_access_key)
+
+
+def apply_sts_credentials(credentials, expired_access_key=None):
+    """Returns the cached (or refreshed) AssumeRole credentials of the role as one consistent snapshot
+
+    The snapshot is also written into `credentials` for callers reading them from there, but `credentials` is
+    shared between threads, so clients must be built from the returned snapshot only.
+    """
+    sts_credentials = get_sts_credentials(credentials, expired_access_key)
+    session_credentials = dict(access_key=sts_credentials.get('AccessKeyId'),
+                               secret_key=sts_credentials.get('SecretAccessKey'),
+                               session_token=sts_credentials.get('SessionToken'))
+    credentials.update(session_credentials)
+    return session_credentials
+
+
+def get_results_from_paginator(client, operation_name, operation_args, response_key, bucket=None):
     result = list()
     paginator = client.get_paginator(operation_name)
-    page_iterator = paginator.paginate(**operation_args)
-    for page in page_iterator:
+    if bucket is not None:
+        # Every page request takes its own token and a throttled page is retried alone, the pages already
+        # fetched are kept. botocore calls the client method of a (per call) paginator through `_method`
+        paginator._method = rate_limited(bucket, paginator._method)
+    for page in paginator.paginate(**operation_args):
         result.extend(page.get(response_key, []))
     return result
 
 
+def rate_limited(bucket, method):
+    def call(**kwargs):
+        def request():
+            bucket.acquire()
+            return method(**kwargs)
+        return bucket.run(request)
+    return call
+
+
+def call_aws_client(client, operation_name, operation_args, response_key, bucket):
+    if response_key and client.can_paginate(operation_name):
+        return get_results_from_paginator(client, operation_name, operation_args, response_key, bucket)
+    return rate_limited(bucket, getattr(client, operation_name))(**operation_args)
+
+
 def run_aws_operation(credentials, service_name, operation_name, operation_args=None, response_key=None,
                       region_name=None, service_endpoint=None):
-    cloud_type = credentials.get("cloud_type", 'aws_standard')
     if operation_args is None:
         operation_args = {}
+    cache = _operation_cache.get()
+    cache_key = None
+    if cache is not None:
+        cache_key = get_operation_cache_key(credentials, service_name, operation_name, operation_args, response_key,
+                                            region_name)
+    if cache_key is None:
+        return _run_aws_operation(credentials, service_name, operation_name, operation_args, response_key,
+                                  region_name, service_endpoint)
+    cached = cache.get(cache_key)
+    if cached is None:
+        cached = _run_aws_operation(credentials, service_name, operation_name, operation_args, response_key,
+                                    region_name, service_endpoint)
+        cache.set(cache_key, cached)
+    # Rules are free to mutate what they get back, so never hand out the cached object itself
+    return deepcopy(cached)
+
+
+def get_client_args(credentials, region_name=None, endpoint_url=None):
     client_args = {
         "aws_access_key_id": credentials['access_key'],
         "aws_secret_access_key": credentials['secret_key']
     }
-    if 'session_token' in credentials:
+    if credentials.get('session_token'):
         client_args['aws_session_token'] = credentials['session_token']
+    if region_name:
+        client_args['region_name'] = region_name
+    if endpoint_url:
+        client_args['endpoint_url'] = endpoint_url
+    return client_args
+
+
+def _run_aws_operation(credentials, service_name, operation_name, operation_args, response_key, region_name,
+                       service_endpoint):
+    cloud_type = credentials.get("cloud_type", 'aws_standard')
+    if credentials.get('assume_role_arn') and credentials.get('assume_role_access_key'):
+        session_credentials = apply_sts_credentials(credentials)
+    else:
+        session_credentials = dict(credentials)
     if cloud_type == "aws_gov_cloud" and not region_name:
         region_name = "us-gov-west-1"
+    endpoint_url = None
     if region_name:
-        client_args['region_name'] = region_name
         endpoint_url = get_custom_endpoint_aws(service_endpoint or service_name, region_name)
-        if endpoint_url:
-            client_args['endpoint_url'] = endpoint_url
-    client = boto3.client(service_name, **client_args)
+    bucket = aws_rate_limiter.get_bucket(credentials.get('assume_role_arn') or session_credentials['access_key'],
+                                         region_name, service_name)
+    client_args = get_client_args(session_credentials, region_name, endpoint_url)
+    client = get_aws_client(service_name, **client_args)
     try:
-        if response_key and client.can_paginate(operation_name):
-            return get_results_from_paginator(client, operation_name, operation_args, response_key)
-        else:
-            retry = 1
-            while True:
-                try:
-                    return getattr(client, operation_name)(**operation_args)
-                except Exception as e:
-                    if "Throttling" in str(e):
-                        if retry >= 15:
-                            raise e
-                        time.sleep(5 * retry)
-                    else:
-                        raise e
-                retry += 1
+        return call_aws_client(client, operation_name, operation_args, response_key, bucket)
     except ClientError as e:
         if '(ExpiredToken)' in str(e) or '(RequestExpired)' in str(e) or '(ExpiredTokenException)' in str(e):
-            sts_credentials = get_sts_credentials(credentials)
-            client_args.update(
-                aws_access_key_id=sts_credentials.get('AccessKeyId'),
-                aws_secret_access_key=sts_credentials.get('SecretAccessKey'),
-                aws_session_token=sts_credentials.get('SessionToken')
-            )
-            credentials.update(
-                access_key=sts_credentials.get('AccessKeyId'),
-                secret_key=sts_credentials.get('SecretAccessKey'),
-                session_token=sts_credentials.get('SessionToken'))
-            client = boto3.client(service_name, **client_args)
-            if response_key and client.can_paginate(operation_name):
-                return get_results_from_paginator(client, operation_name, operation_args, response_key)
-            else:
-                retry = 0
-                while True:
-                    try:
-                        return getattr(client, operation_name)(**operation_args)
-                    except Exception as e:
-                        if "Throttling" in str(e):
-                            if retry > 10:
-                                raise e
-                            time.sleep(5)
-                        else:
-                            raise e
-                    retry += 1
+            session_credentials = apply_sts_credentials(credentials,
+                                                        expired_access_key=client_args['aws_access_key_id'])
+            client = get_aws_client(service_name, **get_client_args(session_credentials, region_name, endpoint_url))
+            return call_aws_client(client, operation_name, operation_args, response_key, bucket)
         raise e
 
 
+class VpcEndpointResolver(object):
+    """(service, region) -> VPC endpoint URL table of the `vpc_endpoint` settings of corestack.conf
+
+    The file is parsed once, and again only when its mtime changes. Endpoints are computed once per
+    (service, region), and the interface endpoint identifiers once per service.
+    """
+
+    def __init__(self, path=CORESTACK_CONF_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._conf_reader = None
+        self._endpoints = dict()
+        self._endpoint_identifiers = dict()
+
+    def refresh(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        with self._lock:
+            if mtime == self._mtime and self._conf_reader is not None:
+                return
+            conf_reader = ConfigParser()
+            if mtime is not None:
+                conf_reader.read(self.path)
+            self._conf_reader, self._mtime = conf_reader, mtime
+            self._endpoints, self._endpoint_identifiers = dict(), dict()
+
+    def get_endpoint_identifiers(self, service):
+        if service not in self._endpoint_identifiers:
+            self._endpoint_identifiers[service] = yaml.safe_load(
+                self._conf_reader.get('interface_endpoint_identifier', service))
+        return self._endpoint_identifiers[service]
+
+    def resolve(self, service, region):
+        self.refresh()
+        with self._lock:
+            if (service, region) not in self._endpoints:
+                self._endpoints[(service, region)] = self._resolve(service, region)
+            return self._endpoints[(service, region)]
+
+    def _resolve(self, service, region):
+        custom_endpoint = None
+        try:
+            if self._conf_reader.sections():
+                conf_reader = self._conf_reader
+                is_vpc_enabled = json.loads(conf_reader.get('vpc_endpoint', 'enabled').lower())
+                private_dns_enabled = json.loads(conf_reader.get('vpc_endpoint', 'private_dns_enabled'))
+                if service == 'sts' and not region:
+                    # Use default region for STS service alone
+                    region = 'us-east-1'
+
+                if service and region:
+                    if is_vpc_enabled and private_dns_enabled:
+                        custom_endpoint = 'https://%s.%s.amazonaws.com' % (service, region)
+                    else:
+                        interface_supported_endpoints = conf_reader.get('vpc_endpoint',
+                                                                        'interface_supported_endpoints')
+                        if is_vpc_enabled and service in interface_supported_endpoints:
+                            vpc_endpoint_identifier = self.get_endpoint_identifiers(service).get(region)
+                            if vpc_endpoint_identifier:
+                                custom_endpoint = 'https://%s.%s.%s.vpce.amazonaws.com' % (
+                                    vpc_endpoint_identifier, service, region)
+        except (NoSectionError, NoOptionError, AttributeError):
+            pass
+        return custom_endpoint
+
+
+vpc_endpoint_resolver = VpcEndpointResolver()
+
+
 def get_custom_endpoint_aws(service, region):
-    custom_endpoint = None
-    try:
-        conf_reader = ConfigParser()
-        config_content = conf_reader.read('/etc/corestack/corestack.conf')
-        if config_content:
-            is_vpc_enabled = json.loads(conf_reader.get('vpc_endpoint', 'enabled').lower())
-            private_dns_enabled = json.loads(conf_reader.get('vpc_endpoint', 'private_dns_enabled'))
-            if service == 'sts' and not region:
-                # Use default region for STS service alone
-                region = 'us-east-1'
-
-            if service and region:
-                if is_vpc_enabled and private_dns_enabled:
-                    custom_endpoint = 'https://%s.%s.amazonaws.com' % (service, region)
-                else:
-                    interface_supported_endpoints = conf_reader.get('vpc_endpoint', 'interface_supported_endpoints')
-                    if is_vpc_enabled and service in interface_supported_endpoints:
-                        vpc_endpoint_identifier = yaml.safe_load(
-                            conf_reader.get('interface_endpoint_identifier', service)).get(region)
-                        if vpc_endpoint_identifier:
-                            custom_endpoint = 'https://%s.%s.%s.vpce.amazonaws.com' % (
-                                vpc_endpoint_identifier, service, region)
-    except (NoSectionError, NoOptionError, AttributeError):
-        pass
-    return custom_endpoint
+    return vpc_endpoint_resolver.resolve(service, region)
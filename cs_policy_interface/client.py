@@ -2,18 +2,23 @@
 # 'LICENSE.txt', which is part of this source code package.
 
 import importlib
-import json
-import re
+import time
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from bson import ObjectId
 
 from cs_policy_interface import exceptions, validate
+from cs_policy_interface.aws_utils import aws_operation_cache
 from cs_policy_interface.definitions import ConnectorEngines
 from cs_policy_interface.exceptions import BadRequestException
 from cs_policy_interface.managed_code import ManagedCode
 from cs_policy_interface.utils import get_result_from_mongo, call_sql_asyn, get_execution_parameter_required, \
-    datetime_parser
+    get_execution_parameters_required, get_mongo_query_template, resource_name_resolver, service_account_ref_cache, \
+    iter_result_from_mongo, iter_result_from_sql_command, MONGO_STREAM_BATCH_SIZE, SQL_FETCH_BATCH_SIZE
+
+SQL_MAX_CONCURRENT_POLICIES = 8
 
 
 class Executor(object):
@@ -24,8 +29,16 @@ class Executor(object):
         self.execution_args = execution_args
         if 'args' not in self.execution_args:
             self.execution_args['args'] = {}
+        self.sql_service_account_id = None
+        self.deadline = None
 
     def execute_rule(self, rule_name, class_name=None):
+        # Callers running many rules for one account can wrap them in their own `aws_operation_cache()`
+        # so describe/list responses are shared across the whole run
+        with aws_operation_cache():
+            return self._execute_rule(rule_name, class_name)
+
+    def _execute_rule(self, rule_name, class_name=None):
         try:
             if not class_name:
                 class_name = "RuleExecutor"
@@ -53,6 +66,12 @@ class Executor(object):
             validate.validate_connection_args(query_source, self.connection_args)
         except ValueError:
             policy_type, query_source, engine_schema = self.validate()
+        return self._execute_validated(policy_type, query_source, engine_schema)
+
+    def _execute_validated(self, policy_type, query_source, engine_schema):
+        """Executes a policy whose content, execution args and connection args were already validated"""
+        if self.execution_args.get('policy_timeout'):
+            self.deadline = time.monotonic() + self.execution_args['policy_timeout']
         try:
             service_account_id = self.execution_args['service_account_id']
             if engine_schema.get('code_ref'):
@@ -65,26 +84,17 @@ class Executor(object):
                 return violations, evaluated_resources
             evaluated_resources = 0
             if query_source == ConnectorEngines.sql:
-                service_account_command = "SELECT ServiceAccountID FROM report.ServiceAccount " \
-                                          "WHERE isDeleted=0 AND ID='%s';" % service_account_id
-                service_account_ref = call_sql_asyn(self.connection_args, service_account_command)
-                if not service_account_ref:
-                    raise BadRequestException('Data Not Available.')
-                service_account_id = service_account_ref[0]['ServiceAccountID']
+                service_account_id = self.get_sql_service_account_id()
                 if policy_type == 'managed':
-                    command_args_list = ['@%s=%s' % (engine_schema['service_account_ref'], service_account_id)]
-                    command_args_list = get_execution_parameter_required(engine_schema, self.execution_args,
-                                                                         command_args_list)
-                    for param_key, param_value in self.execution_args['args'].items():
-                        if isinstance(param_value, list):
-                            param_value = ','.join(param_value)
-                        if not isinstance(param_value, str):
-                            command_args_list.append("@%s=%s" % (param_key, param_value))
-                        else:
-                            command_args_list.append("@%s='%s'" % (param_key, param_value))
-                    command_args = ', '.join(command_args_list)
-                    command = 'EXEC %s %s;' % (engine_schema['query_source_identifier'], command_args)
-                    result = call_sql_asyn(self.connection_args, command)
+                    if self.execution_args.get('parameterized_sql'):
+                        command, parameters = self.get_parameterized_procedure_command(engine_schema,
+                                                                                       service_account_id)
+                    else:
+                        command, parameters = self.get_procedure_command(engine_schema, service_account_id), None
+                    if self.is_sql_streamed():
+                        return self.stream_sql(command, parameters, total_count_row=bool(
+                            engine_schema.get("assessment_ref") and self.execution_args.get("IsAssessment"))), 0
+                    result = self.call_sql(command, parameters)
                     if result:
                         if engine_schema.get("assessment_ref") and self.execution_args.get("IsAssessment"):
                             if "TotalResourceCount" in result[-1]:
@@ -92,6 +102,13 @@ class Executor(object):
                                 del result[-1]
                         if result:
                             result = self.resource_id_format(result)
+                elif self.execution_args.get('parameterized_sql'):
+                    command, parameters = self.get_parameterized_query_command(engine_schema, service_account_id)
+                    if self.is_sql_streamed():
+                        return self.stream_sql(command, parameters), 0
+                    result = self.call_sql(command, parameters)
+                    if result:
+                        result = self.resource_id_format(result)
                 else:
                     command_args = {elem['service_account_ref']: service_account_id for elem in engine_schema}
                     for param_key, param_value in self.execution_args['args'].items():
@@ -105,61 +122,301 @@ class Executor(object):
                         else:
                             command_args[param_key] = "'%s'" % param_value
                     command = self.content['Query'].format(**command_args)
-                    result = call_sql_asyn(self.connection_args, command)
+                    if self.is_sql_streamed():
+                        return self.stream_sql(command), 0
+                    result = self.call_sql(command)
                     if result:
                         result = self.resource_id_format(result)
             else:
-                match_query = engine_schema.get('default_query', {})
-                service_account_ref = engine_schema['service_account_ref']
-                if service_account_ref.get('key_type') == 'string':
-                    match_query[service_account_ref['key_name']] = service_account_id
-                else:
-                    match_query[service_account_ref['key_name']] = ObjectId(service_account_id)
-                if policy_type == 'custom':
-                    query = self.content['Query']
-                    input_parameters = self.content.get('InputParameters', {})
+                aggregate_query = self.get_mongo_aggregate_query(
+                    policy_type, engine_schema, get_service_account_key(engine_schema, service_account_id))
+                if self.execution_args.get('stream_results'):
+                    # The caller iterates the violations, `result.count` is the number seen so far
+                    result = iter_result_from_mongo(
+                        self.connection_args, engine_schema['database_ref'], engine_schema['query_source_identifier'],
+                        aggregate_query, self.execution_args.get('result_batch_size') or MONGO_STREAM_BATCH_SIZE,
+                        self.execution_args.get('result_projection'))
                 else:
-                    query = engine_schema['query']
-                    input_parameters = engine_schema.get('input_parameters', {})
-                for param_key, param_value in self.execution_args['args'].items():
-                    if not (isinstance(param_value, str) and input_parameters[param_key].get('query_field')):
-                        param_value = json.dumps(param_value)
-                    query = re.sub(r'{%s}' % param_key, param_value, query)
-                aggregate_query = json.loads(query, object_hook=datetime_parser)
-                if '$match' in aggregate_query[0]:
-                    aggregate_query[0]['$match'].update(match_query)
-                else:
-                    aggregate_query.insert(0, {'$match': match_query})
-                result = get_result_from_mongo(self.connection_args, engine_schema['database_ref'],
-                                               engine_schema['query_source_identifier'], aggregate_query)
+                    result = get_result_from_mongo(self.connection_args, engine_schema['database_ref'],
+                                                   engine_schema['query_source_identifier'], aggregate_query)
             return result, int(evaluated_resources)
         except Exception as e:
             error = 'Traceback > {}, Error => {}. Rule {}'.format(traceback.format_exc(), str(e),
                                                                   engine_schema.get('name'))
             raise exceptions.PolicyInterfaceClientException(error)
 
-    def resource_id_format(self, result):
-        resources = dict()
-        output = list()
-        for violation in result:
-            resource_id = violation.get("ResourceId", '')
-            if resource_id and resource_id not in resources:
-                resources[resource_id] = violation
-        if not resources:
-            return output
-        # FIXME: resource_id_format should removed once all SP's are updated
-        resource_name_query = "SELECT ResourceID, ResourceName, Name FROM report.ServiceResourceInventory " \
-                              "WHERE ResourceID IN (%s);" % ', '.join(["'%s'" % elem for elem in resources.keys()])
+    def get_mongo_aggregate_query(self, policy_type, engine_schema, service_account_match):
+        match_query = engine_schema.get('default_query', {})
+        match_query[engine_schema['service_account_ref']['key_name']] = service_account_match
+        if policy_type == 'custom':
+            query = self.content['Query']
+            input_parameters = self.content.get('InputParameters', {})
+        else:
+            query = engine_schema['query']
+            input_parameters = engine_schema.get('input_parameters', {})
+        aggregate_query = get_mongo_query_template(query, input_parameters).bind(self.execution_args['args'])
+        if '$match' in aggregate_query[0]:
+            aggregate_query[0]['$match'].update(match_query)
+        else:
+            aggregate_query.insert(0, {'$match': match_query})
+        return aggregate_query
+
+    def execute_policy_for_accounts(self, service_account_ids, *args):
+        """Evaluates one MongoDB query policy for many service accounts with a single aggregation.
+
+        The accounts are matched with `$in` and the violations are split per account on the client, using a
+        field carried through the pipeline. Pipelines that merge documents across accounts (`$group`, `$limit`,
+        ...) cannot be split that way and are executed once per account instead.
+        :return: {service_account_id: (violations, evaluated_resources)}
+        """
+        try:
+            policy_type, query_source, engine_schema = args
+        except ValueError:
+            policy_type, query_source, engine_schema = validate.validate_content(self.content, self.mongo_args)
+        if not service_account_ids:
+            return OrderedDict()
+        validate.validate_execution_args(self.content, dict(self.execution_args,
+                                                            service_account_id=service_account_ids[0]))
+        validate.validate_connection_args(query_source, self.connection_args)
+        if query_source != ConnectorEngines.mongodb or engine_schema.get('code_ref'):
+            raise BadRequestException('Only MongoDB query policies can be evaluated for many accounts at once.')
+        try:
+            # Accounts are keyed the way the tracked field reads back from MongoDB
+            service_account_ids = list(OrderedDict.fromkeys(
+                str(get_service_account_key(engine_schema, service_account_id))
+                for service_account_id in service_account_ids))
+            aggregate_query = self.get_mongo_aggregate_query(policy_type, engine_schema, {"$in": [
+                get_service_account_key(engine_schema, service_account_id)
+                for service_account_id in service_account_ids]})
+            aggregate_query = track_service_account(aggregate_query, engine_schema['service_account_ref']['key_name'])
+        except Exception as e:
+            error = 'Traceback > {}, Error => {}. Rule {}'.format(traceback.format_exc(), str(e),
+                                                                  engine_schema.get('name'))
+            raise exceptions.PolicyInterfaceClientException(error)
+        if aggregate_query is None:
+            return self.execute_per_account(service_account_ids, policy_type, query_source, engine_schema)
+        results = OrderedDict((service_account_id, (list(), 0)) for service_account_id in service_account_ids)
         try:
-            resource_name_ref = call_sql_asyn(self.connection_args, resource_name_query)
-        except Exception:
-            resource_name_ref = list()
-        for elem in resource_name_ref:
-            violation_data = resources.pop(elem['ResourceID'])
-            violation_data.update(ResourceId=elem['ResourceName'])
-            if elem.get('Name'):
-                violation_data.update(ResourceName=elem['Name'])
-            output.append(violation_data)
-        for elem in resources.values():
-            output.append(elem)
-        return output
+            for violation in get_result_from_mongo(self.connection_args, engine_schema['database_ref'],
+                                                   engine_schema['query_source_identifier'], aggregate_query):
+                service_account_id = str(violation.pop(TRACKED_SERVICE_ACCOUNT_FIELD, None))
+                if service_account_id not in results:
+                    # The pipeline lost or rewrote the tracked account, the violations cannot be split
+                    break
+                results[service_account_id][0].append(violation)
+            else:
+                return results
+        except Exception as e:
+            error = 'Traceback > {}, Error => {}. Rule {}'.format(traceback.format_exc(), str(e),
+                                                                  engine_schema.get('name'))
+            raise exceptions.PolicyInterfaceClientException(error)
+        return self.execute_per_account(service_account_ids, policy_type, query_source, engine_schema)
+
+    def execute_per_account(self, service_account_ids, policy_type, query_source, engine_schema):
+        results = OrderedDict()
+        for service_account_id in service_account_ids:
+            executor = Executor(self.content, dict(self.connection_args),
+                                dict(self.execution_args, service_account_id=service_account_id), self.mongo_args)
+            results[service_account_id] = executor._execute_validated(policy_type, query_source, engine_schema)
+        return results
+
+    def get_procedure_command(self, engine_schema, service_account_id):
+        command_args_list = ['@%s=%s' % (engine_schema['service_account_ref'], service_account_id)]
+        command_args_list = get_execution_parameter_required(engine_schema, self.execution_args, command_args_list)
+        for param_key, param_value in self.execution_args['args'].items():
+            if isinstance(param_value, list):
+                param_value = ','.join(param_value)
+            if not isinstance(param_value, str):
+                command_args_list.append("@%s=%s" % (param_key, param_value))
+            else:
+                command_args_list.append("@%s='%s'" % (param_key, param_value))
+        command_args = ', '.join(command_args_list)
+        return 'EXEC %s %s;' % (engine_schema['query_source_identifier'], command_args)
+
+    def get_parameterized_procedure_command(self, engine_schema, service_account_id):
+        parameters = OrderedDict([(engine_schema['service_account_ref'], service_account_id)])
+        parameters = get_execution_parameters_required(engine_schema, self.execution_args, parameters)
+        for param_key, param_value in self.execution_args['args'].items():
+            parameters[param_key] = ','.join(param_value) if isinstance(param_value, list) else param_value
+        command = 'EXEC %s %s;' % (engine_schema['query_source_identifier'],
+                                   ', '.join('@%s=@%s' % (name, name) for name in parameters))
+        return command, parameters
+
+    def get_parameterized_query_command(self, engine_schema, service_account_id):
+        parameters = OrderedDict()
+        placeholders = dict()
+        for elem in engine_schema:
+            parameters[elem['service_account_ref']] = service_account_id
+            placeholders[elem['service_account_ref']] = '@%s' % elem['service_account_ref']
+        for param_key, param_value in self.execution_args['args'].items():
+            if isinstance(param_value, list):
+                names = ['%s_%s' % (param_key, position) for position in range(len(param_value))]
+                parameters.update(zip(names, param_value))
+                placeholders[param_key] = '(%s)' % ', '.join('@%s' % name for name in names)
+            else:
+                parameters[param_key] = param_value
+                placeholders[param_key] = '@%s' % param_key
+        return self.content['Query'].format(**placeholders), parameters
+
+    def get_remaining_time(self):
+        """Seconds left before the `policy_timeout` deadline, None without a deadline"""
+        if self.deadline is None:
+            return None
+        timeout = self.deadline - time.monotonic()
+        if timeout <= 0:
+            raise Exception('Policy execution timed out after %s seconds.' % self.execution_args['policy_timeout'])
+        return timeout
+
+    def call_sql(self, command, parameters=None):
+        return call_sql_asyn(self.connection_args, command, self.get_remaining_time(), parameters)
+
+    def is_sql_streamed(self):
+        # The `execute_url` proxy answers with the whole result at once, only direct connections can stream
+        return bool(self.execution_args.get('stream_results') and not self.connection_args.get('execute_url'))
+
+    def stream_sql(self, command, parameters=None, total_count_row=False):
+        """Violations of a SQL command streamed from the database, formatted one batch at a time
+
+        The caller iterates the violations, `result.count` is the number seen so far and, with `total_count_row`,
+        `result.evaluated_resources` is the assessment total once the violations are exhausted.
+        """
+        seen = set()
+        return iter_result_from_sql_command(
+            self.connection_args, command, parameters, self.get_remaining_time(),
+            self.execution_args.get('result_batch_size') or SQL_FETCH_BATCH_SIZE,
+            lambda rows: self.resource_id_format(rows, seen), total_count_row)
+
+    def get_sql_service_account_id(self):
+        if self.sql_service_account_id is None:
+            service_account_id = self.execution_args['service_account_id']
+            self.sql_service_account_id = service_account_ref_cache.get(self.connection_args, service_account_id)
+        if self.sql_service_account_id is None:
+            if self.execution_args.get('parameterized_sql'):
+                service_account_ref = self.call_sql(
+                    "SELECT ServiceAccountID FROM report.ServiceAccount WHERE isDeleted=0 AND ID=@ID;",
+                    OrderedDict(ID=self.execution_args['service_account_id']))
+            else:
+                service_account_command = "SELECT ServiceAccountID FROM report.ServiceAccount " \
+                                          "WHERE isDeleted=0 AND ID='%s';" % self.execution_args['service_account_id']
+                service_account_ref = self.call_sql(service_account_command)
+            if not service_account_ref:
+                raise BadRequestException('Data Not Available.')
+            self.sql_service_account_id = service_account_ref[0]['ServiceAccountID']
+            service_account_ref_cache.set(self.connection_args, self.execution_args['service_account_id'],
+                                          self.sql_service_account_id)
+        return self.sql_service_account_id
+
+    def execute_policies(self, contents, policy_args=None, source_connection_args=None):
+        """Executes a list of policies for the service account of this executor.
+
+        :param contents: list of policy contents
+        :param policy_args: optional list of `args` aligned with `contents`, defaults to `execution_args['args']`
+        :param source_connection_args: optional connection args per query source (`SQL`/`MongoDB`),
+                                       defaults to the connection args of this executor
+        :return: list aligned with `contents`, each item being
+                 {"status": True, "data": violations, "evaluated_resources": count} or
+                 {"status": False, "message": error}
+        """
+        source_connection_args = source_connection_args or dict()
+        results = [None] * len(contents)
+        data_sources = OrderedDict()
+        for index, content in enumerate(contents):
+            args = policy_args[index] if policy_args else self.execution_args['args']
+            try:
+                policy_type, query_source, engine_schema = validate.validate_content(content, self.mongo_args)
+                connection_args = dict(source_connection_args.get(query_source, self.connection_args))
+                executor = Executor(content, connection_args, dict(self.execution_args, args=args), self.mongo_args)
+                validate.validate_execution_args(content, executor.execution_args)
+                validate.validate_connection_args(query_source, connection_args)
+            except Exception as e:
+                results[index] = {"status": False, "message": str(e)}
+                continue
+            data_source = get_policy_data_source(content, policy_type, query_source, engine_schema)
+            data_sources.setdefault(data_source, list()).append(
+                (index, executor, (policy_type, query_source, engine_schema)))
+        sql_policies, other_policies = list(), list()
+        for data_source, policies in data_sources.items():
+            for index, executor, validated in policies:
+                if not is_sql_query_policy(validated[1], validated[2]):
+                    other_policies.append((index, executor, validated))
+                    continue
+                try:
+                    # Resolved once, the other executors hit `service_account_ref_cache`
+                    executor.get_sql_service_account_id()
+                    sql_policies.append((index, executor, validated))
+                except Exception as e:
+                    results[index] = {"status": False, "message": str(e)}
+        # SQL policies only wait on the SQL proxy, so all of them, whatever their data source, are kept in flight
+        # together while the other policies run
+        with aws_operation_cache(), \
+                ThreadPoolExecutor(max_workers=max(1, min(SQL_MAX_CONCURRENT_POLICIES, len(sql_policies)))) as pool:
+            futures = [(index, pool.submit(self.execute_batched_policy, executor, validated))
+                       for index, executor, validated in sql_policies]
+            for index, executor, validated in other_policies:
+                results[index] = self.execute_batched_policy(executor, validated)
+            for index, future in futures:
+                results[index] = future.result()
+        return results
+
+    @staticmethod
+    def execute_batched_policy(executor, validated):
+        try:
+            # Validated once by `execute_policies`
+            violations, evaluated_resources = executor._execute_validated(*validated)
+            return {"status": True, "data": violations, "evaluated_resources": evaluated_resources}
+        except Exception as e:
+            return {"status": False, "message": str(e)}
+
+    def resource_id_format(self, result, seen=None):
+        # FIXME: resource_id_format should removed once all SP's are updated
+        return resource_name_resolver.format_violations(self.connection_args, result, seen,
+                                                        self.get_remaining_time())
+
+
+def get_policy_data_source(content, policy_type, query_source, engine_schema):
+    """Key identifying where a validated policy reads its data from, used to batch policies together"""
+    if policy_type == 'custom':
+        return query_source, content.get('QuerySourceIdentifier') or 'Query'
+    if engine_schema.get('code_ref'):
+        return query_source, engine_schema.get('database_ref'), engine_schema['code_ref']
+    return query_source, engine_schema.get('database_ref'), engine_schema.get('query_source_identifier')
+
+
+def is_sql_query_policy(query_source, engine_schema):
+    return query_source == ConnectorEngines.sql and not (
+        isinstance(engine_schema, dict) and engine_schema.get('code_ref'))
+
+
+def get_service_account_key(engine_schema, service_account_id):
+    if engine_schema['service_account_ref'].get('key_type') == 'string':
+        return service_account_id
+    return ObjectId(service_account_id)
+
+
+TRACKED_SERVICE_ACCOUNT_FIELD = '_cs_service_account_id'
+# Stages which keep documents of different accounts apart, so the account of each output document is known
+ACCOUNT_PRESERVING_STAGES = ('$match', '$project', '$addFields', '$set', '$unset', '$unwind', '$lookup', '$sort')
+
+
+def track_service_account(aggregate_query, key_name):
+    """Carries the account of every document through the pipeline in `TRACKED_SERVICE_ACCOUNT_FIELD`.
+
+    Returns None when a stage of the pipeline mixes or drops documents across accounts.
+    """
+    tracked_query = [aggregate_query[0], {"$addFields": {TRACKED_SERVICE_ACCOUNT_FIELD: "$%s" % key_name}}]
+    for stage in aggregate_query[1:]:
+        stage_name = next(iter(stage))
+        if stage_name not in ACCOUNT_PRESERVING_STAGES:
+            return None
+        if stage_name == '$project':
+            projection = dict(stage['$project'])
+            if all(value in (0, False) for value in projection.values()):
+                # Exclusions keep every other field, they only must not drop the tracked one
+                projection.pop(TRACKED_SERVICE_ACCOUNT_FIELD, None)
+                if not projection:
+                    continue
+            else:
+                projection[TRACKED_SERVICE_ACCOUNT_FIELD] = 1
+            stage = {'$project': projection}
+        tracked_query.append(stage)
+    return tracked_query
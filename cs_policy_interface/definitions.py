@@ -20,7 +20,8 @@ connection_args_config = {
         'port': OPTIONAL,
         'execute_url': OPTIONAL,
         'auth_user': OPTIONAL,
-        'auth_password': OPTIONAL
+        'auth_password': OPTIONAL,
+        'timeout': OPTIONAL
     }
 }
 
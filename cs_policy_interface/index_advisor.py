@@ -0,0 +1,306 @@
+# This file is subject to the terms and conditions defined in the file
+# 'LICENSE.txt', which is part of this source code package.
+
+"""Index advisor for the MongoDB queries of managed rules
+
+Collects the `$match`/`find` filter shapes used by the `data/managed.json` queries and by the `ManagedCode`
+methods, explains them against a target database, reports the ones answered by a collection scan and can
+create the recommended compound indexes.
+
+Usage:
+    python -m cs_policy_interface.index_advisor --host localhost --port 27017 [--database billing] [--create]
+"""
+
+import argparse
+import ast
+import json
+import os
+from collections import OrderedDict
+
+from cs_policy_interface.utils import INVENTORY_SYNC_QUERY, STRING_SLOT_MARKER, InventoryFreshness, \
+    engine_schema_registries, get_mongo_client, get_mongo_query_template
+
+QUERY_METHODS = ('find', 'find_one', 'aggregate', 'count_documents')
+RANGE_OPERATORS = ('$gt', '$gte', '$lt', '$lte', '$ne', '$nin', '$exists', '$regex', '$not')
+# `utils` helpers running the filters a rule passes them: helper -> (position, keyword) of every filter argument,
+# the inventory collection being their first argument
+HELPER_FILTER_ARGUMENTS = {
+    'find_orphaned_resources': ((1, 'parent_query'), (3, 'child_query')),
+    'join_inventory_documents': ((3, 'match_query'),)
+}
+# Fields matched first by (almost) every rule, put in front of the recommended indexes
+LEADING_FIELDS = ('service_account_id',)
+
+
+class QueryShape(object):
+    def __init__(self, database, collection, equality_fields, range_fields, sources):
+        self.database = database
+        self.collection = collection
+        self.equality_fields = equality_fields
+        self.range_fields = range_fields
+        self.sources = sources
+
+    @property
+    def key(self):
+        return self.database, self.collection, tuple(self.equality_fields), tuple(self.range_fields)
+
+    def get_index_keys(self):
+        """Equality fields first (leading fields in front), range fields last"""
+        equality_fields = [field for field in LEADING_FIELDS if field in self.equality_fields] + \
+                          [field for field in self.equality_fields if field not in LEADING_FIELDS]
+        return [(field, 1) for field in equality_fields + self.range_fields]
+
+    def get_sample_filter(self):
+        sample_filter = OrderedDict()
+        for field in self.equality_fields:
+            sample_filter[field] = ''
+        for field in self.range_fields:
+            sample_filter[field] = {'$gt': ''}
+        return sample_filter
+
+
+def split_filter_fields(match_filter):
+    equality_fields, range_fields = list(), list()
+    for field, value in match_filter.items():
+        if field.startswith('$') or STRING_SLOT_MARKER in field:
+            # $and/$or/$expr and field names built from input parameters are not reduced to index keys
+            continue
+        if isinstance(value, dict) and any(operator in RANGE_OPERATORS for operator in value):
+            range_fields.append(field)
+        else:
+            equality_fields.append(field)
+    return equality_fields, range_fields
+
+
+def add_shape(shapes, database, collection, match_filter, source):
+    equality_fields, range_fields = split_filter_fields(match_filter)
+    if not equality_fields and not range_fields:
+        return
+    shape = QueryShape(database, collection, equality_fields, range_fields, [source])
+    if shape.key in shapes:
+        if source not in shapes[shape.key].sources:
+            shapes[shape.key].sources.append(source)
+    else:
+        shapes[shape.key] = shape
+
+
+def collect_schema_shapes(shapes):
+    for engine_schema in engine_schema_registries['managed'].get_all():
+        if engine_schema.get('query_source') != 'MongoDB' or not engine_schema.get('query'):
+            continue
+        pipeline = get_mongo_query_template(engine_schema['query'],
+                                            engine_schema.get('input_parameters', {})).pipeline
+        match_filter = dict(engine_schema.get('default_query', {}))
+        if pipeline and '$match' in pipeline[0]:
+            match_filter.update(pipeline[0]['$match'])
+        service_account_ref = engine_schema.get('service_account_ref', {})
+        if service_account_ref.get('key_name'):
+            match_filter[service_account_ref['key_name']] = ''
+        add_shape(shapes, engine_schema['database_ref'], engine_schema['query_source_identifier'], match_filter,
+                  engine_schema['name'])
+
+
+def literal_dict(node):
+    """Keys of a dict literal, values reduced to operator dicts, or None if `node` is not a dict literal"""
+    if not isinstance(node, ast.Dict):
+        return None
+    result = OrderedDict()
+    for key, value in zip(node.keys, node.values):
+        if not isinstance(key, ast.Constant) or not isinstance(key.value, str):
+            continue
+        operators = literal_dict(value)
+        result[key.value] = {k: None for k in operators if k.startswith('$')} if operators else None
+    return result
+
+
+def get_receiver(node):
+    """(database variable, collection name) of `<db>[<collection>].<method>` / `<db>.<collection>.<method>`"""
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name):
+        collection = node.slice
+        if isinstance(collection, ast.Constant) and isinstance(collection.value, str):
+            return node.value.id, collection.value
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+        return node.value.id, node.attr
+    return None, None
+
+
+def get_pipeline_match(pipeline, variables):
+    """`$match` of the first stage of a pipeline list literal, as returned by `literal_dict`"""
+    if isinstance(pipeline, ast.Name):
+        pipeline = variables.get(pipeline.id)
+    if not (isinstance(pipeline, ast.List) and pipeline.elts):
+        return None
+    stage = pipeline.elts[0]
+    match_node = None
+    if isinstance(stage, ast.Dict):
+        match_node = next((value for key, value in zip(stage.keys, stage.values)
+                           if isinstance(key, ast.Constant) and key.value == '$match'), None)
+    if isinstance(match_node, ast.Name):
+        match_node = variables.get(match_node.id)
+    return literal_dict(match_node)
+
+
+def get_argument(node, position, keyword, variables):
+    if len(node.args) > position:
+        argument = node.args[position]
+    else:
+        argument = next((elem.value for elem in node.keywords if elem.arg == keyword), None)
+    if isinstance(argument, ast.Name):
+        return variables.get(argument.id, argument)
+    return argument
+
+
+def get_constant(node, default=None):
+    return node.value if isinstance(node, ast.Constant) and isinstance(node.value, str) else default
+
+
+def collect_helper_call_shapes(shapes, node, variables, databases, source):
+    """Filters a rule passes to the `utils` query helpers"""
+    helper = node.func.id
+    if helper in HELPER_FILTER_ARGUMENTS:
+        database_variable, collection = get_receiver(get_argument(node, 0, 'collection', variables))
+        if not collection:
+            return
+        for position, keyword in HELPER_FILTER_ARGUMENTS[helper]:
+            match_filter = literal_dict(get_argument(node, position, keyword, variables))
+            if match_filter and helper == 'join_inventory_documents':
+                # Joined with `{inventory_key: {"$in": [...]}}`
+                match_filter[get_constant(get_argument(node, 4, 'inventory_key', variables),
+                                          'check_resource_element')] = None
+            if match_filter:
+                add_shape(shapes, databases.get(database_variable), collection, match_filter, source)
+    elif helper == 'iter_result_from_mongo':
+        database = get_constant(get_argument(node, 1, 'database_name', variables))
+        collection = get_constant(get_argument(node, 2, 'collection_name', variables))
+        match_filter = get_pipeline_match(get_argument(node, 3, 'aggregate_query', variables), variables)
+        if collection and match_filter:
+            add_shape(shapes, database, collection, match_filter, source)
+
+
+def is_mongo_client_call(node):
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'get_mongo_client'
+
+
+def collect_code_shapes(shapes, source_path=None):
+    source_path = source_path or os.path.join(os.path.abspath(os.path.dirname(__file__)), 'managed_code.py')
+    with open(source_path) as f:
+        tree = ast.parse(f.read())
+    for function in ast.walk(tree):
+        if not isinstance(function, ast.FunctionDef):
+            continue
+        source = 'ManagedCode.%s' % function.name
+        variables, databases = dict(), dict()
+        for node in ast.walk(function):
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+                variables[node.targets[0].id] = node.value
+        # `<db> = get_mongo_client(...)['<database>']` or `<client> = get_mongo_client(...)` and then
+        # `<db> = <client>['<database>']`
+        clients = {name for name, value in variables.items() if is_mongo_client_call(value)}
+        for name, value in variables.items():
+            if isinstance(value, ast.Subscript) and isinstance(value.slice, ast.Constant) and (
+                    is_mongo_client_call(value.value) or
+                    (isinstance(value.value, ast.Name) and value.value.id in clients)):
+                databases[name] = value.slice.value
+        for node in ast.walk(function):
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+                collect_helper_call_shapes(shapes, node, variables, databases, source)
+                continue
+            if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and
+                    node.func.attr in QUERY_METHODS and node.args):
+                continue
+            database_variable, collection = get_receiver(node.func.value)
+            if not collection:
+                continue
+            argument = node.args[0]
+            if isinstance(argument, ast.Name):
+                argument = variables.get(argument.id)
+            if node.func.attr == 'aggregate':
+                match_filter = get_pipeline_match(argument, variables)
+            else:
+                match_filter = literal_dict(argument)
+            if match_filter:
+                add_shape(shapes, databases.get(database_variable), collection, match_filter, source)
+
+
+def collect_helper_shapes(shapes):
+    """Filters built by the `utils` helpers themselves rather than by the rules calling them"""
+    match_filter = dict(INVENTORY_SYNC_QUERY, service_account_id='')
+    # Sorted on, so it follows the equality fields in the index
+    match_filter[InventoryFreshness.sort_field] = {'$lte': None}
+    add_shape(shapes, InventoryFreshness.database_name, InventoryFreshness.collection_name, match_filter,
+              'InventoryFreshness.get_last_sync')
+
+
+def collect_query_shapes():
+    shapes = OrderedDict()
+    collect_schema_shapes(shapes)
+    collect_code_shapes(shapes)
+    collect_helper_shapes(shapes)
+    return list(shapes.values())
+
+
+def get_plan_stages(plan):
+    stages = [plan.get('stage')]
+    for child_key in ('inputStage', 'queryPlan'):
+        if isinstance(plan.get(child_key), dict):
+            stages.extend(get_plan_stages(plan[child_key]))
+    for child in plan.get('inputStages', []):
+        stages.extend(get_plan_stages(child))
+    return stages
+
+
+def explain_shape(client, shape, default_database):
+    database = shape.database or default_database
+    explanation = client[database].command('explain', {'find': shape.collection,
+                                                       'filter': shape.get_sample_filter()},
+                                           verbosity='queryPlanner')
+    return get_plan_stages(explanation.get('queryPlanner', {}).get('winningPlan', {}))
+
+
+def advise_indexes(connection_args, default_database=None, create=False):
+    """Explains every collected query shape, returns a report of the shapes answered by a collection scan
+
+    :param default_database: database of `ManagedCode` queries running on the rule connection database
+    :param create: create the recommended index of every collection scan found
+    """
+    client = get_mongo_client(connection_args)
+    report = list()
+    for shape in collect_query_shapes():
+        if not (shape.database or default_database):
+            continue
+        database = shape.database or default_database
+        try:
+            stages = explain_shape(client, shape, default_database)
+        except Exception as e:
+            report.append({"database": database, "collection": shape.collection, "sources": shape.sources,
+                           "error": str(e)})
+            continue
+        if 'COLLSCAN' not in stages:
+            continue
+        index_keys = shape.get_index_keys()
+        finding = {"database": database, "collection": shape.collection, "sources": shape.sources,
+                   "plan": stages, "recommended_index": index_keys, "created": False}
+        if create:
+            client[database][shape.collection].create_index(index_keys, background=True)
+            finding['created'] = True
+        report.append(finding)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report (and create) MongoDB indexes missing for managed rules')
+    parser.add_argument('--host', required=True)
+    parser.add_argument('--port', required=True)
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--auth-database', dest='auth_database')
+    parser.add_argument('--database', help='database of the ManagedCode queries on the rule connection')
+    parser.add_argument('--create', action='store_true', help='create the recommended indexes')
+    options = parser.parse_args()
+    connection_args = {key: getattr(options, key) for key in ('host', 'port', 'username', 'password',
+                                                               'auth_database')}
+    print(json.dumps(advise_indexes(connection_args, options.database, options.create), indent=2))
+
+
+if __name__ == '__main__':
+    main()
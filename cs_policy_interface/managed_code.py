@@ -36,10 +36,19 @@ from cs_policy_interface.definitions import NetworkConfigurationAccess
 from cs_policy_interface.definitions import services_protocol_port
 from cs_policy_interface.gcp_utils import run_big_query_job, run_bigquery_job_for_oauth2_type, get_credential
 from cs_policy_interface.utils import AccessNestedDict, rem_duplicates_from_op
-from cs_policy_interface.utils import get_mongo_client
+from cs_policy_interface.utils import ORPHAN_OUTPUT_FIELDS, find_orphaned_resources
+from cs_policy_interface.utils import get_mongo_client, inventory_freshness, iter_result_from_mongo, \
+    join_inventory_documents
 
 
 THIRTY_MIN_TIMEOUT_LIMIT = 1800
+# Every key is always present, as the snapshot rule emitted them before using `find_orphaned_resources`
+DISK_SNAPSHOT_ORPHAN_OUTPUT_FIELDS = OrderedDict(
+    (name, {"$ifNull": [field, "NA" if name == "ResourceName" else None]})
+    for name, field in ORPHAN_OUTPUT_FIELDS.items())
+COSMOS_ORPHAN_OUTPUT_FIELDS = OrderedDict(ORPHAN_OUTPUT_FIELDS, Region="NA",
+                                          MinimumThroughput="$extended_summary_details.properties.minimumThroughput",
+                                          Throughput="$extended_summary_details.properties.throughput")
 
 
 class ManagedCode(object):
@@ -296,8 +305,9 @@ class ManagedCode(object):
         try:
             service_account_id = self.execution_args.get("service_account_id")
             elapsed_days = self.execution_args['args'].get("ElapsedDays")
-            billing_db = get_mongo_client(self.connection_args)[self.connection_args['database_name']]
-            inventory_db = get_mongo_client(self.connection_args)['resource_inventory']
+            mongo_client = get_mongo_client(self.connection_args)
+            billing_db = mongo_client[self.connection_args['database_name']]
+            inventory_db = mongo_client['resource_inventory']
             check_date = datetime.utcnow() - timedelta(days=int(elapsed_days))
             check_date = check_date.replace(hour=00, minute=00, second=00, microsecond=00)
             query = [
@@ -314,15 +324,14 @@ class ManagedCode(object):
             ]
             results = billing_db['workspace_utilization_daily'].aggregate(query, cursor={})
             evaluated_resources = 0
-            for result in results:
+            inventory_query = {
+                "service_account_id": service_account_id,
+                "resource": self.execution_args.get("resource"),
+                "is_deleted": False
+            }
+            for result, resource_details in join_inventory_documents(
+                    inventory_db["service_resource_inventory"], results, "_id", inventory_query):
                 resource_id = result["_id"]
-                inventory_query = {
-                    "service_account_id": service_account_id,
-                    "check_resource_element": resource_id,
-                    "resource": self.execution_args.get("resource"),
-                    "is_deleted": False
-                }
-                resource_details = inventory_db["service_resource_inventory"].find_one(inventory_query)
                 if resource_details:
                     evaluated_resources += 1
                     resource_properties = resource_details.get("summary_details", {}).get("WorkspaceProperties", {})
@@ -354,8 +363,9 @@ class ManagedCode(object):
             power_pro_limit = self.execution_args['args'].get("PowerProLimit")
             graphics_limit = self.execution_args['args'].get("GraphicsLimit")
             graphics_pro_limit = self.execution_args['args'].get("GraphicsProLimit")
-            billing_db = get_mongo_client(self.connection_args)[self.connection_args['database_name']]
-            inventory_db = get_mongo_client(self.connection_args)['resource_inventory']
+            mongo_client = get_mongo_client(self.connection_args)
+            billing_db = mongo_client[self.connection_args['database_name']]
+            inventory_db = mongo_client['resource_inventory']
             check_date = datetime.utcnow().replace(day=1, hour=00, minute=00, second=00, microsecond=00)
             query = [
                 {"$match": {"service_account_id": service_account_id,
@@ -369,14 +379,13 @@ class ManagedCode(object):
             ]
             results = billing_db['workspace_utilization_daily'].aggregate(query, cursor={})
             evaluated_resources = 0
-            for result in results:
+            inventory_query = {
+                "service_account_id": service_account_id,
+                "is_deleted": False
+            }
+            for result, resource_details in join_inventory_documents(
+                    inventory_db["service_resource_inventory"], results, "_id", inventory_query):
                 resource_id = result["_id"]
-                inventory_query = {
-                    "service_account_id": service_account_id,
-                    "check_resource_element": resource_id,
-                    "is_deleted": False
-                }
-                resource_details = inventory_db["service_resource_inventory"].find_one(inventory_query)
                 if resource_details:
                     evaluated_resources += 1
                     resource_properties = resource_details.get("summary_details", {}).get("WorkspaceProperties", {})
@@ -13980,20 +13989,7 @@ class ManagedCode(object):
 
     def discovery_check(self, service_account_id):
         try:
-            inventory_db = get_mongo_client(self.connection_args)['resource_inventory']
-            completed_date = datetime.utcnow() - timedelta(hours=24)
-            query_to_check = {"service_account_id": service_account_id, "is_deleted": False,
-                              "rediscover_status": "completed", "is_active": True, "data_sync.status": "success",
-                              "overall_status": "completed", "data_sync.completed_at": {'$gt': completed_date},
-                              "data_sync.message": "Completed buckets sync"}
-            account_info = list()
-            account_details = inventory_db["service_inventory_dependency_configuration"].find_one(query_to_check)
-            if account_details:
-                account_info.append(account_details)
-            if len(account_info) != 0:
-                return True
-            else:
-                return False
+            return inventory_freshness.is_fresh(self.connection_args, service_account_id)
         except Exception as e:
             raise Exception(str(e))
 
@@ -14064,24 +14060,32 @@ class ManagedCode(object):
             output = list()
             service_account_id = self.execution_args["service_account_id"]
             elapsed_days = self.execution_args['args'].get("ElapsedDays")
-            inventory_db = get_mongo_client(self.connection_args)['resource_inventory']
             if self.discovery_check(service_account_id):
-                inventory_query = {"service_account_id": service_account_id, "category": "Storage",
-                                   "resource_type": "S3", "resource": "Objects", "is_deleted": False}
-                objects_in_inventory = list(inventory_db["service_resource_dependent_inventory"].find(inventory_query))
-                if len(objects_in_inventory) != 0:
-                    for objects in objects_in_inventory:
-                        last_modified = parse(objects.get("summary_details").get("LastModified"))
-                        days_to_check = datetime.now(timezone.utc) - last_modified
-                        if days_to_check.days > int(elapsed_days):
-                            response = {"ResourceId": objects.get("check_resource_element"),
-                                        "BucketName": objects.get("summary_details").get("bucketName"),
-                                        "ResourceType": objects.get("resource_type", ""),
-                                        "Region": objects.get("location", ""),
-                                        "Resource": objects.get("resource", ""),
-                                        "Size": objects.get("summary_details").get("Size"),
-                                        "LastModified": last_modified.isoformat()}
-                            output.append(response)
+                # More than `elapsed_days` full days old, evaluated by the server on the parsed LastModified
+                modified_before = datetime.utcnow() - timedelta(days=int(elapsed_days) + 1)
+                aged_objects_query = [
+                    {"$match": {"service_account_id": service_account_id, "category": "Storage",
+                                "resource_type": "S3", "resource": "Objects", "is_deleted": False}},
+                    {"$addFields": {"last_modified": {"$cond": [
+                        {"$eq": [{"$type": "$summary_details.LastModified"}, "date"]},
+                        "$summary_details.LastModified",
+                        {"$dateFromString": {"dateString": "$summary_details.LastModified",
+                                             "onError": None, "onNull": None}}]}}},
+                    {"$match": {"last_modified": {"$lte": modified_before}}}]
+                aged_objects = iter_result_from_mongo(
+                    self.connection_args, 'resource_inventory', 'service_resource_dependent_inventory',
+                    aged_objects_query, projection={
+                        "_id": 0,
+                        "ResourceId": "$check_resource_element",
+                        "BucketName": "$summary_details.bucketName",
+                        "ResourceType": {"$ifNull": ["$resource_type", ""]},
+                        "Region": {"$ifNull": ["$location", ""]},
+                        "Resource": {"$ifNull": ["$resource", ""]},
+                        "Size": "$summary_details.Size",
+                        "LastModified": "$last_modified"})
+                for response in aged_objects:
+                    response["LastModified"] = response["LastModified"].replace(tzinfo=timezone.utc).isoformat()
+                    output.append(response)
             return output, len(output)
         except Exception as e:
             raise Exception(str(e))
@@ -15534,65 +15538,28 @@ class ManagedCode(object):
 
     def azure_storage_disk_snapshots_orphaned(self):
         try:
-            output = list()
-            evaluated_resources = 0
             service_account_id = self.execution_args["service_account_id"]
             inventory_db = get_mongo_client(self.connection_args)['resource_inventory']
-            inventory_query = {"service_account_id": service_account_id,
-                               "resource_type": "Storage_Disks",
-                               "resource": "Snapshot",
-                               "is_deleted": False}
-            resource_list = inventory_db["service_resource_inventory"].find(inventory_query)
-            for inventory in resource_list:
-                resource_id = inventory.get("summary_details", {}).get("properties", {}).get("creationData", {}).get(
-                    "sourceResourceId", "")
-                if not resource_id:
-                    orphaned_data = {
-                        "Resource": inventory.get("resource"),
-                        "ResourceType": inventory.get("resource_type"),
-                        "ResourceId": inventory.get("check_resource_element"),
-                        "Region": inventory.get("location"),
-                        "ServiceAccountId": inventory.get("service_account_id"),
-                        "ResourceName": inventory.get("summary_details.name"),
-                        "ResourceCategory": inventory.get("category")
-                    }
-                    output.append(orphaned_data)
-                    continue
-                resource_existence_query = {
-                    "service_account_id": service_account_id,
-                    "check_resource_element": {"$regex": resource_id, "$options": "$i"},
-                    "is_deleted": False,
-                    "resource": "Disks",
-                    "resource_type": "Storage_Disks"
-                }
-                resource_existence_check = inventory_db["service_resource_inventory"].find(resource_existence_query).count()
-                if  resource_existence_check:
-                    continue
-                orphaned_data = {
-                    "Resource": inventory.get("resource"),
-                    "ResourceType": inventory.get("resource_type"),
-                    "ResourceId": inventory.get("check_resource_element"),
-                    "Region": inventory.get("location"),
-                    "ServiceAccountId": inventory.get("service_account_id"),
-                    "ResourceName": inventory.get("summary_details",{}).get("name","NA"),
-                    "ResourceCategory": inventory.get("category")
-                }
-                output.append(orphaned_data)
-            total_resource_query = {
-                "service_account_id": service_account_id,
-                "resource_type": "Storage_Disks",
-                "resource": "Snapshot",
-                "is_deleted": False
-            }
-            evaluated_resources = inventory_db["service_resource_inventory"].find(total_resource_query).count()
+            disk_query = {"service_account_id": service_account_id,
+                          "resource_type": "Storage_Disks",
+                          "resource": "Disks",
+                          "is_deleted": False}
+            snapshot_query = {"service_account_id": service_account_id,
+                              "resource_type": "Storage_Disks",
+                              "resource": "Snapshot",
+                              "is_deleted": False}
+            # A snapshot is orphaned when its source id equals no disk id (compared case-insensitively), or when
+            # it has no source. The former per-snapshot $regex also matched disk ids merely containing the source id
+            output, evaluated_resources = find_orphaned_resources(
+                inventory_db["service_resource_inventory"], disk_query, "check_resource_element", snapshot_query,
+                child_key="summary_details.properties.creationData.sourceResourceId",
+                output_fields=DISK_SNAPSHOT_ORPHAN_OUTPUT_FIELDS, ignore_case=True)
             return output, evaluated_resources
         except Exception as e:
             raise Exception(str(e))
 
     def azure_mysql_db_servers_orphaned(self):
         try:
-            output = list()
-            evaluated_resources = 0
             service_account_id = self.execution_args["service_account_id"]
             inventory_db = get_mongo_client(self.connection_args)['resource_inventory']
             database_query = {"service_account_id": service_account_id,
@@ -15604,43 +15571,19 @@ class ManagedCode(object):
                                        {"check_resource_element": "performance_schema"},
                                        {"check_resource_element": "sys"}]
                               }
-            db_parent_list = inventory_db["service_resource_inventory"].distinct(
-                "additional_attributes.check_resource_parent_id", database_query)
-            orphaned_sql_servers = inventory_db["service_resource_inventory"].aggregate([{"$match": {
-                "service_account_id": service_account_id,
-                "resource_type": "Servers",
-                "resource": "MySQL",
-                "is_deleted": False,
-                "check_resource_element": {"$nin": db_parent_list}
-            }},
-                {"$project": {
-                    "_id": 0,
-                    "Resource": "$resource",
-                    "ResourceType": "$resource_type",
-                    "ResourceId": "$check_resource_element",
-                    "Region": "$location",
-                    "ServiceAccountId": "$service_account_id",
-                    "ResourceName": "$summary_details.name",
-                    "ResourceCategory": "$category"
-                }}
-            ])
-            output = list(orphaned_sql_servers)
-            total_resource_query = {
-                "service_account_id": service_account_id,
-                "resource_type": "Servers",
-                "resource": "MySQL",
-                "is_deleted": False
-            }
-            total_resource = inventory_db["service_resource_inventory"].find(total_resource_query)
-            evaluated_resources = len(list(total_resource))
+            server_query = {"service_account_id": service_account_id,
+                            "resource_type": "Servers",
+                            "resource": "MySQL",
+                            "is_deleted": False}
+            output, evaluated_resources = find_orphaned_resources(
+                inventory_db["service_resource_inventory"], database_query,
+                "additional_attributes.check_resource_parent_id", server_query)
             return output, evaluated_resources
         except Exception as e:
             raise Exception(str(e))
 
     def azure_pgsql_db_servers_orphaned(self):
         try:
-            output = list()
-            evaluated_resources = 0
             service_account_id = self.execution_args["service_account_id"]
             inventory_db = get_mongo_client(self.connection_args)['resource_inventory']
             database_query = {"service_account_id": service_account_id,
@@ -15651,43 +15594,19 @@ class ManagedCode(object):
                                        {"check_resource_element": {"$regex": "databases/azure_maintenance"}},
                                        {"check_resource_element": {"$regex": "databases/postgres"}}]
                               }
-            db_parent_list = inventory_db["service_resource_inventory"].distinct(
-                "additional_attributes.check_resource_parent_id", database_query)
-            orphaned_sql_servers = inventory_db["service_resource_inventory"].aggregate([{"$match": {
-                "service_account_id": service_account_id,
-                "resource_type": "Servers",
-                "resource": "PGSQL",
-                "is_deleted": False,
-                "check_resource_element": {"$nin": db_parent_list}
-            }},
-                {"$project": {
-                    "_id": 0,
-                    "Resource": "$resource",
-                    "ResourceType": "$resource_type",
-                    "ResourceId": "$check_resource_element",
-                    "Region": "$location",
-                    "ServiceAccountId": "$service_account_id",
-                    "ResourceName": "$summary_details.name",
-                    "ResourceCategory": "$category"
-                }}
-            ])
-            output = list(orphaned_sql_servers)
-            total_resource_query = {
-                "service_account_id": service_account_id,
-                "resource_type": "Servers",
-                "resource": "PGSQL",
-                "is_deleted": False
-            }
-            total_resource = inventory_db["service_resource_inventory"].find(total_resource_query)
-            evaluated_resources = len(list(total_resource))
+            server_query = {"service_account_id": service_account_id,
+                            "resource_type": "Servers",
+                            "resource": "PGSQL",
+                            "is_deleted": False}
+            output, evaluated_resources = find_orphaned_resources(
+                inventory_db["service_resource_inventory"], database_query,
+                "additional_attributes.check_resource_parent_id", server_query)
             return output, evaluated_resources
         except Exception as e:
             raise Exception(str(e))
 
     def azure_maria_db_servers_orphaned(self):
         try:
-            output = list()
-            evaluated_resources = 0
             service_account_id = self.execution_args["service_account_id"]
             inventory_db = get_mongo_client(self.connection_args)['resource_inventory']
             database_query = {"service_account_id": service_account_id,
@@ -15699,35 +15618,13 @@ class ManagedCode(object):
                                        {"check_resource_element": {"$regex": "databases/mysql"}},
                                        {"check_resource_element": {"$regex": "databases/information_schema"}}]
                               }
-            db_parent_list = inventory_db["service_resource_inventory"].distinct(
-                "additional_attributes.check_resource_parent_id", database_query)
-            orphaned_sql_servers = inventory_db["service_resource_inventory"].aggregate([{"$match": {
-                "service_account_id": service_account_id,
-                "resource_type": "Servers",
-                "resource": "MariaDB",
-                "is_deleted": False,
-                "check_resource_element": {"$nin": db_parent_list}
-            }},
-                {"$project": {
-                    "_id": 0,
-                    "Resource": "$resource",
-                    "ResourceType": "$resource_type",
-                    "ResourceId": "$check_resource_element",
-                    "Region": "$location",
-                    "ServiceAccountId": "$service_account_id",
-                    "ResourceName": "$summary_details.name",
-                    "ResourceCategory": "$category"
-                }}
-            ])
-            output = list(orphaned_sql_servers)
-            total_resource_query = {
-                "service_account_id": service_account_id,
-                "resource_type": "Servers",
-                "resource": "MariaDB",
-                "is_deleted": False
-            }
-            total_resource = inventory_db["service_resource_inventory"].find(total_resource_query)
-            evaluated_resources = len(list(total_resource))
+            server_query = {"service_account_id": service_account_id,
+                            "resource_type": "Servers",
+                            "resource": "MariaDB",
+                            "is_deleted": False}
+            output, evaluated_resources = find_orphaned_resources(
+                inventory_db["service_resource_inventory"], database_query,
+                "additional_attributes.check_resource_parent_id", server_query)
             return output, evaluated_resources
         except Exception as e:
             raise Exception(str(e))
@@ -15741,42 +15638,18 @@ class ManagedCode(object):
                 inventory_db = get_mongo_client(self.connection_args)[self.connection_args['database_name']]
             except Exception as e:
                 raise Exception('Unable to connect to the db. Error {}'.format(str(e)))
-            query = {"service_account_id": service_account_id,
-                     "resource_type": "Servers",
-                     "resource": "Elastic_Pool_Database",
-                     "is_deleted": False
-                     }
-            elastic_pool_db_list = inventory_db["service_resource_inventory"].distinct(
-                "meta_data.ElasticPoolsList", query)
-            orphaned_elastic_pool_db = list(inventory_db["service_resource_inventory"].aggregate([
-                {"$match": {"service_account_id": service_account_id,
+            parent_query = {"service_account_id": service_account_id,
                             "resource_type": "Servers",
-                            "resource": "Elastic_Pools",
+                            "resource": "Elastic_Pool_Database",
                             "is_deleted": False
-                            }},
-                {"$facet": {"output": [{
-                    "$match":
-                        {"check_resource_element": {"$nin": elastic_pool_db_list}}},
-                    {"$project": {
-                        "_id": 0,
-                        "Resource": "$resource",
-                        "ResourceType": "$resource_type",
-                        "ResourceId": "$check_resource_element",
-                        "Region": "$location",
-                        "ServiceAccountId": "$service_account_id",
-                        "ResourceName": "$summary_details.name",
-                        "ResourceCategory": "$category"
-                    }}],
-                    "evaluated_resource": [{"$count": "totalRecords"}]}}]))
-
-            if "output" in orphaned_elastic_pool_db[0]:
-                output = orphaned_elastic_pool_db[0]["output"]
-            if "evaluated_resource" in orphaned_elastic_pool_db[0]:
-                evaluated_resources = orphaned_elastic_pool_db[0]["evaluated_resource"]
-                if len(evaluated_resources) > 0:
-                    evaluated_resources = evaluated_resources[0]["totalRecords"]
-                else:
-                    evaluated_resources = 0
+                            }
+            child_query = {"service_account_id": service_account_id,
+                           "resource_type": "Servers",
+                           "resource": "Elastic_Pools",
+                           "is_deleted": False
+                           }
+            output, evaluated_resources = find_orphaned_resources(
+                inventory_db["service_resource_inventory"], parent_query, "meta_data.ElasticPoolsList", child_query)
             return output, evaluated_resources
         except Exception as e:
             raise Exception(str(e))
@@ -15882,49 +15755,25 @@ class ManagedCode(object):
                 inventory_db = get_mongo_client(self.connection_args)[self.connection_args['database_name']]
             except Exception as e:
                 raise Exception('Unable to connect to the db. Error {}'.format(str(e)))
-            collections_query = {"service_account_id": service_account_id,
-                                 "resource_type": "Cosmos_DB",
-                                 "resource": "MongoDB_Collections",
-                                 "is_deleted": False
-                                 }
-            collection_list = inventory_db["service_resource_inventory"].distinct(
-                "meta_data.MongoDatabasesList", collections_query)
-            orphaned_mongo_servers = list(inventory_db["service_resource_inventory"].aggregate([
-                {"$match": {"service_account_id": service_account_id,
+            parent_query = {"service_account_id": service_account_id,
                             "resource_type": "Cosmos_DB",
-                            "resource": "Mongo_Databases",
+                            "resource": "MongoDB_Collections",
                             "is_deleted": False
-                            }},
-                {"$facet": {"output": [{
-                    "$match":
-                        {"check_resource_element": {"$nin": collection_list}}},
-                    {"$project": {
-                        "_id": 0,
-                        "Resource": "$resource",
-                        "ResourceType": "$resource_type",
-                        "ResourceId": "$check_resource_element",
-                        "Region": "NA",
-                        "ServiceAccountId": "$service_account_id",
-                        "ResourceName": "$summary_details.name",
-                        "ResourceCategory": "$category",
-                        "MinimumThroughput": "$extended_summary_details.properties.minimumThroughput",
-                        "Throughput": "$extended_summary_details.properties.throughput"
-                    }}],
-                    "evaluated_resource": [{"$count": "totalRecords"}]}}]))
-            if "output" in orphaned_mongo_servers[0]:
-                output_detail = orphaned_mongo_servers[0]["output"]
-                for detail in output_detail:
-                    if "MinimumThroughput" in detail.keys():
-                        if int(detail.get('MinimumThroughput', 0)) <= int(detail.get('Throughput', 0)):
-                            detail.pop("MinimumThroughput")
-                            detail.pop("Throughput")
-                            output.append(detail)
-            if "evaluated_resource" in orphaned_mongo_servers[0]:
-                evaluated_resources = orphaned_mongo_servers[0]["evaluated_resource"]
-                if len(evaluated_resources) > 0:
-                    evaluated_resources = evaluated_resources[0]["totalRecords"]
-                else:
-                    evaluated_resources = 0
+                            }
+            child_query = {"service_account_id": service_account_id,
+                           "resource_type": "Cosmos_DB",
+                           "resource": "Mongo_Databases",
+                           "is_deleted": False
+                           }
+            orphaned, evaluated_resources = find_orphaned_resources(
+                inventory_db["service_resource_inventory"], parent_query, "meta_data.MongoDatabasesList", child_query,
+                output_fields=COSMOS_ORPHAN_OUTPUT_FIELDS)
+            for detail in orphaned:
+                if "MinimumThroughput" in detail.keys():
+                    if int(detail.get('MinimumThroughput', 0)) <= int(detail.get('Throughput', 0)):
+                        detail.pop("MinimumThroughput")
+                        detail.pop("Throughput")
+                        output.append(detail)
             return output, evaluated_resources
         except Exception as e:
             raise Exception(str(e))
@@ -15938,51 +15787,25 @@ class ManagedCode(object):
                 inventory_db = get_mongo_client(self.connection_args)[self.connection_args['database_name']]
             except Exception as e:
                 raise Exception('Unable to connect to the db. Error {}'.format(str(e)))
-
-            query = {"service_account_id": service_account_id,
-                     "resource_type": "Cosmos_DB",
-                     "resource": "Cassandra_Keyspace_Table",
-                     "is_deleted": False
-                     }
-            cassandra_keyspace_list = inventory_db["service_resource_inventory"].distinct(
-                "meta_data.CassandraKeySpaceList", query)
-
-            orphaned_cassandra_keyspace = list(inventory_db["service_resource_inventory"].aggregate([
-                {"$match": {"service_account_id": service_account_id,
+            parent_query = {"service_account_id": service_account_id,
                             "resource_type": "Cosmos_DB",
-                            "resource": "Cassandra_Keyspace",
+                            "resource": "Cassandra_Keyspace_Table",
                             "is_deleted": False
-                            }},
-                {"$facet": {"output": [{
-                    "$match":
-                        {"check_resource_element": {"$nin": cassandra_keyspace_list}}},
-                    {"$project": {
-                        "_id": 0,
-                        "Resource": "$resource",
-                        "ResourceType": "$resource_type",
-                        "ResourceId": "$check_resource_element",
-                        "Region": "NA",
-                        "ServiceAccountId": "$service_account_id",
-                        "ResourceName": "$summary_details.name",
-                        "ResourceCategory": "$category",
-                        "MinimumThroughput": "$extended_summary_details.properties.minimumThroughput",
-                        "Throughput": "$extended_summary_details.properties.throughput"
-                    }}],
-                    "evaluated_resource": [{"$count": "totalRecords"}]}}]))
-            if "output" in orphaned_cassandra_keyspace[0]:
-                output_detail = orphaned_cassandra_keyspace[0]["output"]
-                for detail in output_detail:
-                    if "MinimumThroughput" in detail.keys():
-                        if int(detail.get('MinimumThroughput', 0)) <= int(detail.get('Throughput', 0)):
-                            detail.pop("MinimumThroughput")
-                            detail.pop("Throughput")
-                            output.append(detail)
-            if "evaluated_resource" in orphaned_cassandra_keyspace[0]:
-                evaluated_resources = orphaned_cassandra_keyspace[0]["evaluated_resource"]
-                if len(evaluated_resources) > 0:
-                    evaluated_resources = evaluated_resources[0]["totalRecords"]
-                else:
-                    evaluated_resources = 0
+                            }
+            child_query = {"service_account_id": service_account_id,
+                           "resource_type": "Cosmos_DB",
+                           "resource": "Cassandra_Keyspace",
+                           "is_deleted": False
+                           }
+            orphaned, evaluated_resources = find_orphaned_resources(
+                inventory_db["service_resource_inventory"], parent_query, "meta_data.CassandraKeySpaceList", child_query,
+                output_fields=COSMOS_ORPHAN_OUTPUT_FIELDS)
+            for detail in orphaned:
+                if "MinimumThroughput" in detail.keys():
+                    if int(detail.get('MinimumThroughput', 0)) <= int(detail.get('Throughput', 0)):
+                        detail.pop("MinimumThroughput")
+                        detail.pop("Throughput")
+                        output.append(detail)
             return output, evaluated_resources
         except Exception as e:
             raise Exception(str(e))
@@ -15996,50 +15819,25 @@ class ManagedCode(object):
                 inventory_db = get_mongo_client(self.connection_args)[self.connection_args['database_name']]
             except Exception as e:
                 raise Exception('Unable to connect to the db. Error {}'.format(str(e)))
-            query = {"service_account_id": service_account_id,
-                     "resource_type": "Cosmos_DB",
-                     "resource": "Cosmos_SQL_Containers",
-                     "is_deleted": False
-                     }
-            sql_table_list = inventory_db["service_resource_inventory"].distinct(
-                "meta_data.CosmosSQLDatabasesList", query)
-
-            orphaned_sql_db = list(inventory_db["service_resource_inventory"].aggregate([
-                {"$match": {"service_account_id": service_account_id,
+            parent_query = {"service_account_id": service_account_id,
                             "resource_type": "Cosmos_DB",
-                            "resource": "Cosmos_SQL_Databases",
+                            "resource": "Cosmos_SQL_Containers",
                             "is_deleted": False
-                            }},
-                {"$facet": {"output": [{
-                    "$match":
-                        {"check_resource_element": {"$nin": sql_table_list}}},
-                    {"$project": {
-                        "_id": 0,
-                        "Resource": "$resource",
-                        "ResourceType": "$resource_type",
-                        "ResourceId": "$check_resource_element",
-                        "Region": "NA",
-                        "ServiceAccountId": "$service_account_id",
-                        "ResourceName": "$summary_details.name",
-                        "ResourceCategory": "$category",
-                        "MinimumThroughput": "$extended_summary_details.properties.minimumThroughput",
-                        "Throughput": "$extended_summary_details.properties.throughput"
-                    }}],
-                    "evaluated_resource": [{"$count": "totalRecords"}]}}]))
-            if "output" in orphaned_sql_db[0]:
-                output_detail = orphaned_sql_db[0]["output"]
-                for detail in output_detail:
-                    if "MinimumThroughput" in detail.keys():
-                        if int(detail.get('MinimumThroughput', 0)) <= int(detail.get('Throughput', 0)):
-                            detail.pop("MinimumThroughput")
-                            detail.pop("Throughput")
-                            output.append(detail)
-            if "evaluated_resource" in orphaned_sql_db[0]:
-                evaluated_resources = orphaned_sql_db[0]["evaluated_resource"]
-                if len(evaluated_resources) > 0:
-                    evaluated_resources = evaluated_resources[0]["totalRecords"]
-                else:
-                    evaluated_resources = 0
+                            }
+            child_query = {"service_account_id": service_account_id,
+                           "resource_type": "Cosmos_DB",
+                           "resource": "Cosmos_SQL_Databases",
+                           "is_deleted": False
+                           }
+            orphaned, evaluated_resources = find_orphaned_resources(
+                inventory_db["service_resource_inventory"], parent_query, "meta_data.CosmosSQLDatabasesList", child_query,
+                output_fields=COSMOS_ORPHAN_OUTPUT_FIELDS)
+            for detail in orphaned:
+                if "MinimumThroughput" in detail.keys():
+                    if int(detail.get('MinimumThroughput', 0)) <= int(detail.get('Throughput', 0)):
+                        detail.pop("MinimumThroughput")
+                        detail.pop("Throughput")
+                        output.append(detail)
             return output, evaluated_resources
         except Exception as e:
             raise Exception(str(e))
@@ -16053,49 +15851,25 @@ class ManagedCode(object):
                 inventory_db = get_mongo_client(self.connection_args)[self.connection_args['database_name']]
             except Exception as e:
                 raise Exception('Unable to connect to the db. Error {}'.format(str(e)))
-            query = {"service_account_id": service_account_id,
-                     "resource_type": "Cosmos_DB",
-                     "resource": "Gremlin_Graph",
-                     "is_deleted": False
-                     }
-            gremlin_graph_list = inventory_db["service_resource_inventory"].distinct(
-                "meta_data.GremlinDatabaseList", query)
-            orphaned_gremlin_db = list(inventory_db["service_resource_inventory"].aggregate([
-                {"$match": {"service_account_id": service_account_id,
+            parent_query = {"service_account_id": service_account_id,
                             "resource_type": "Cosmos_DB",
-                            "resource": "Gremlin_Databases",
+                            "resource": "Gremlin_Graph",
                             "is_deleted": False
-                            }},
-                {"$facet": {"output": [{
-                    "$match":
-                        {"check_resource_element": {"$nin": gremlin_graph_list}}},
-                    {"$project": {
-                        "_id": 0,
-                        "Resource": "$resource",
-                        "ResourceType": "$resource_type",
-                        "ResourceId": "$check_resource_element",
-                        "Region": "NA",
-                        "ServiceAccountId": "$service_account_id",
-                        "ResourceName": "$summary_details.name",
-                        "ResourceCategory": "$category",
-                        "MinimumThroughput": "$extended_summary_details.properties.minimumThroughput",
-                        "Throughput": "$extended_summary_details.properties.throughput"
-                    }}],
-                    "evaluated_resource": [{"$count": "totalRecords"}]}}]))
-            if "output" in orphaned_gremlin_db[0]:
-                output_detail = orphaned_gremlin_db[0]["output"]
-                for detail in output_detail:
-                    if "MinimumThroughput" in detail.keys():
-                        if int(detail.get('MinimumThroughput', 0)) <= int(detail.get('Throughput', 0)):
-                            detail.pop("MinimumThroughput")
-                            detail.pop("Throughput")
-                            output.append(detail)
-            if "evaluated_resource" in orphaned_gremlin_db[0]:
-                evaluated_resources = orphaned_gremlin_db[0]["evaluated_resource"]
-                if len(evaluated_resources) > 0:
-                    evaluated_resources = evaluated_resources[0]["totalRecords"]
-                else:
-                    evaluated_resources = 0
+                            }
+            child_query = {"service_account_id": service_account_id,
+                           "resource_type": "Cosmos_DB",
+                           "resource": "Gremlin_Databases",
+                           "is_deleted": False
+                           }
+            orphaned, evaluated_resources = find_orphaned_resources(
+                inventory_db["service_resource_inventory"], parent_query, "meta_data.GremlinDatabaseList", child_query,
+                output_fields=COSMOS_ORPHAN_OUTPUT_FIELDS)
+            for detail in orphaned:
+                if "MinimumThroughput" in detail.keys():
+                    if int(detail.get('MinimumThroughput', 0)) <= int(detail.get('Throughput', 0)):
+                        detail.pop("MinimumThroughput")
+                        detail.pop("Throughput")
+                        output.append(detail)
             return output, evaluated_resources
         except Exception as e:
             raise Exception(str(e))
@@ -16283,49 +16057,26 @@ class ManagedCode(object):
             raise Exception(str(e))
 
     def azure_dns_forwarding_rulesets_orphaned(self, *kwargs):
-        evaluated_resources = 0
         output = list()
+        evaluated_resources = 0
         try:
             service_account_id = self.execution_args["service_account_id"]
             try:
                 inventory_db = get_mongo_client(self.connection_args)[self.connection_args['database_name']]
             except Exception as e:
                 raise Exception('Unable to connect to the db. Error {}'.format(str(e)))
-            database_query = {
-                "service_account_id": service_account_id,
-                "resource_type": "DNS_Forwarding_Rulesets",
-                "resource": "DNS_Forwarding_Rules",
-                "is_deleted": False}
-            parent_list = inventory_db["service_resource_inventory"].distinct(
-                "meta_data.ListForwardingDNSZones", database_query)
-            orphaned_rulesets = list(inventory_db["service_resource_inventory"].aggregate([{"$match": {
-                "service_account_id": service_account_id,
-                "resource_type": "DNS_Forwarding_Rulesets",
-                "resource": "DNS_Forwarding_Rulesets",
-                "is_deleted": False
-            }},
-                {"$facet": {"output": [{
-                    "$match":
-                        {"check_resource_element": {"$nin": parent_list}}},
-                    {"$project": {
-                        "_id": 0,
-                        "Resource": "$resource",
-                        "ResourceType": "$resource_type",
-                        "ResourceId": "$check_resource_element",
-                        "Region": "$location",
-                        "ServiceAccountId": "$service_account_id",
-                        "ResourceName": "$summary_details.name",
-                        "ResourceCategory": "$category"
-                    }}],
-                    "evaluated_resource": [{"$count": "totalRecords"}]}}]))
-            if "output" in orphaned_rulesets[0]:
-                output = orphaned_rulesets[0]["output"]
-            if "evaluated_resource" in orphaned_rulesets[0]:
-                evaluated_resources = orphaned_rulesets[0]["evaluated_resource"]
-                if len(evaluated_resources) > 0:
-                    evaluated_resources = evaluated_resources[0]["totalRecords"]
-                else:
-                    evaluated_resources = 0
+            parent_query = {"service_account_id": service_account_id,
+                            "resource_type": "DNS_Forwarding_Rulesets",
+                            "resource": "DNS_Forwarding_Rules",
+                            "is_deleted": False
+                            }
+            child_query = {"service_account_id": service_account_id,
+                           "resource_type": "DNS_Forwarding_Rulesets",
+                           "resource": "DNS_Forwarding_Rulesets",
+                           "is_deleted": False
+                           }
+            output, evaluated_resources = find_orphaned_resources(
+                inventory_db["service_resource_inventory"], parent_query, "meta_data.ListForwardingDNSZones", child_query)
             return output, evaluated_resources
         except Exception as e:
             raise Exception(str(e))
@@ -16370,49 +16121,26 @@ class ManagedCode(object):
             raise Exception(str(e))
 
     def azure_dns_resolver_endpoints_orphaned(self, *kwargs):
-        evaluated_resources = 0
         output = list()
+        evaluated_resources = 0
         try:
             service_account_id = self.execution_args["service_account_id"]
             try:
                 inventory_db = get_mongo_client(self.connection_args)[self.connection_args['database_name']]
             except Exception as e:
                 raise Exception('Unable to connect to the db. Error {}'.format(str(e)))
-            database_query = {
-                "service_account_id": service_account_id,
-                "resource_type": "DNS_Forwarding_Rulesets",
-                "resource": "DNS_Forwarding_Rulesets",
-                "is_deleted": False}
-            parent_list = inventory_db["service_resource_inventory"].distinct(
-                "meta_data.ListDNSResolverOutbound", database_query)
-            orphaned_rulesets = list(inventory_db["service_resource_inventory"].aggregate([{"$match": {
-                "service_account_id": service_account_id,
-                "resource_type": "DNS_Resolvers",
-                "resource": "Resolver_Outbound_Endpoints",
-                "is_deleted": False
-            }},
-                {"$facet": {"output": [{
-                    "$match":
-                        {"check_resource_element": {"$nin": parent_list}}},
-                    {"$project": {
-                        "_id": 0,
-                        "Resource": "$resource",
-                        "ResourceType": "$resource_type",
-                        "ResourceId": "$check_resource_element",
-                        "Region": "$location",
-                        "ServiceAccountId": "$service_account_id",
-                        "ResourceName": "$summary_details.name",
-                        "ResourceCategory": "$category"
-                    }}],
-                    "evaluated_resource": [{"$count": "totalRecords"}]}}]))
-            if "output" in orphaned_rulesets[0]:
-                output = orphaned_rulesets[0]["output"]
-            if "evaluated_resource" in orphaned_rulesets[0]:
-                evaluated_resources = orphaned_rulesets[0]["evaluated_resource"]
-                if len(evaluated_resources) > 0:
-                    evaluated_resources = evaluated_resources[0]["totalRecords"]
-                else:
-                    evaluated_resources = 0
+            parent_query = {"service_account_id": service_account_id,
+                            "resource_type": "DNS_Forwarding_Rulesets",
+                            "resource": "DNS_Forwarding_Rulesets",
+                            "is_deleted": False
+                            }
+            child_query = {"service_account_id": service_account_id,
+                           "resource_type": "DNS_Resolvers",
+                           "resource": "Resolver_Outbound_Endpoints",
+                           "is_deleted": False
+                           }
+            output, evaluated_resources = find_orphaned_resources(
+                inventory_db["service_resource_inventory"], parent_query, "meta_data.ListDNSResolverOutbound", child_query)
             return output, evaluated_resources
         except Exception as e:
             raise Exception(str(e))
@@ -0,0 +1,98 @@
+# This file is subject to the terms and conditions defined in the file
+# 'LICENSE.txt', which is part of this source code package.
+
+import importlib
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from cs_policy_interface.aws_utils import aws_operation_cache
+from cs_policy_interface.client import Executor
+
+# Modules imported once per worker process so the first job of a worker does not pay for them
+WARM_UP_MODULES = ['cs_policy_interface.managed_code', 'cs_policy_interface.validate', 'pandas', 'netaddr',
+                   'sqlparse']
+
+
+def warm_up_worker(modules=None):
+    for module_name in modules or WARM_UP_MODULES:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            pass
+
+
+def get_cloud_account_key(job):
+    execution_args = job['execution_args']
+    auth_values = execution_args.get('auth_values') or {}
+    return (auth_values.get('assume_role_arn') or auth_values.get('access_key') or auth_values.get('tenant_id') or
+            auth_values.get('project_id') or execution_args.get('service_account_id'))
+
+
+def execute_assessment_job(job):
+    """Runs one (account, policy set) job inside a worker process.
+
+    Clients, tokens and schema caches kept at module level by the library stay warm in the worker between jobs.
+    """
+    executor = Executor(None, job['connection_args'], job['execution_args'], job['mongo_args'])
+    if job.get('rules'):
+        results = list()
+        # One scope for the whole job, so the rules of the account share their describe/list responses
+        with aws_operation_cache():
+            for rule in job['rules']:
+                try:
+                    violations, evaluated_resources = executor.execute_rule(rule['code_ref'],
+                                                                            rule.get('class_name'))
+                    results.append({"status": True, "data": violations, "evaluated_resources": evaluated_resources})
+                except Exception as e:
+                    results.append({"status": False, "message": str(e)})
+        return results
+    return executor.execute_policies(job['contents'], job.get('policy_args'), job.get('source_connection_args'))
+
+
+def run_assessments(jobs, max_workers=None, max_in_flight_per_account=1, max_pending=None):
+    """Spreads assessment jobs over a process pool and yields `(job_id, results)` as jobs complete.
+
+    Every job is a dict with `job_id`, `execution_args`, `connection_args`, `mongo_args` and either `contents`
+    (policies, optionally with `policy_args` and `source_connection_args`, see `Executor.execute_policies`) or
+    `rules` (list of {"code_ref", "class_name"} for `Executor.execute_rule`). A failed job yields
+    {"status": False, "message": error} in place of the result list.
+
+    :param max_in_flight_per_account: maximum number of jobs running at once against one cloud account
+    :param max_pending: maximum number of jobs submitted to the pool at once, defaults to twice the worker count
+    """
+    if max_in_flight_per_account < 1:
+        raise ValueError('max_in_flight_per_account must be at least 1, got %s' % max_in_flight_per_account)
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_pending or max_workers * 2
+    if max_pending < 1:
+        raise ValueError('max_pending must be at least 1, got %s' % max_pending)
+    # Jobs queued per account, and the accounts with queued jobs and a free slot, served round robin
+    account_queues = OrderedDict()
+    for job in jobs:
+        account_queues.setdefault(get_cloud_account_key(job), deque()).append(job)
+    ready_accounts = deque(account_queues)
+    in_flight = dict()
+    account_in_flight = dict()
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=warm_up_worker) as pool:
+        while ready_accounts or in_flight:
+            while ready_accounts and len(in_flight) < max_pending:
+                account_key = ready_accounts.popleft()
+                job = account_queues[account_key].popleft()
+                account_in_flight[account_key] = account_in_flight.get(account_key, 0) + 1
+                in_flight[pool.submit(execute_assessment_job, job)] = (job['job_id'], account_key)
+                if account_queues[account_key] and account_in_flight[account_key] < max_in_flight_per_account:
+                    ready_accounts.append(account_key)
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in done:
+                job_id, account_key = in_flight.pop(future)
+                account_in_flight[account_key] -= 1
+                # The account was left out of `ready_accounts` only if it had no free slot
+                if account_queues[account_key] and \
+                        account_in_flight[account_key] == max_in_flight_per_account - 1:
+                    ready_accounts.append(account_key)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    results = {"status": False, "message": str(e)}
+                yield job_id, results
@@ -2,17 +2,25 @@
 # 'LICENSE.txt', which is part of this source code package.
 
 import adal
+import atexit
 import json
 import os
 import re
 import sys
+import threading
+import time
 from base64 import b64encode
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from copy import deepcopy
+from datetime import datetime, timedelta
 
 import pyodbc
 import requests
-import yaql
 from pymongo import MongoClient
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from cs_policy_interface.definitions import AzureUtils
 from cs_policy_interface.definitions import ConnectorEngines, cs_policy_storage
@@ -29,96 +37,829 @@ else:
     from urllib import quote_plus
 
 
+class EngineSchemaRegistry(object):
+    """In-memory index of a coded engine schema file (data/managed.json, data/custom.json)
+
+    The file is parsed once and indexed by `name`, `(query_source, query_source_identifier)` and `code_ref`.
+    It is parsed again only when its mtime changes. Lookups return copies, so callers may mutate them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._by_name = dict()
+        self._by_query_source = dict()
+        self._by_code_ref = dict()
+
+    def refresh(self):
+        mtime = os.path.getmtime(self.path)
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            with open(self.path) as f:
+                entries = json.loads(f.read())
+            by_name, by_query_source, by_code_ref = dict(), dict(), dict()
+            for position, entry in enumerate(entries):
+                if entry.get('name') is not None:
+                    by_name.setdefault(entry['name'], entry)
+                by_query_source.setdefault((entry.get('query_source'), entry.get('query_source_identifier')),
+                                           list()).append((position, entry))
+                if entry.get('code_ref'):
+                    by_code_ref.setdefault(entry['code_ref'], list()).append(entry)
+            self._by_name, self._by_query_source, self._by_code_ref = by_name, by_query_source, by_code_ref
+            self._mtime = mtime
+
+    def get_all(self):
+        self.refresh()
+        return deepcopy(list(self._by_name.values()))
+
+    def get_by_name(self, name):
+        self.refresh()
+        return deepcopy(self._by_name.get(name, {}))
+
+    def get_by_query_source(self, query_source, query_source_identifier):
+        self.refresh()
+        entries = self._by_query_source.get((query_source, query_source_identifier))
+        return deepcopy(entries[0][1]) if entries else {}
+
+    def get_by_query_source_identifiers(self, query_source, query_source_identifiers):
+        self.refresh()
+        entries = list()
+        for query_source_identifier in set(query_source_identifiers):
+            entries.extend(self._by_query_source.get((query_source, query_source_identifier), []))
+        return [deepcopy(entry) for _, entry in sorted(entries, key=lambda elem: elem[0])]
+
+    def get_by_code_ref(self, code_ref):
+        self.refresh()
+        return deepcopy(self._by_code_ref.get(code_ref, []))
+
+
+engine_schema_registries = {
+    policy_type: EngineSchemaRegistry(
+        os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data', '%s.json' % policy_type))
+    for policy_type in ('managed', 'custom')
+}
+
+
+ENGINE_SCHEMA_CACHE_TTL = 300
+
+
+class EngineSchemaCache(object):
+    """Process wide cache of the engine schemas stored in MongoDB (`cs_policy_storage`)
+
+    The whole collection is loaded in one round trip and kept for `ttl` seconds per Mongo connection.
+    Entries can be dropped explicitly with `invalidate`, or kept fresh by a change stream started with `watch`.
+    """
+
+    def __init__(self, ttl=ENGINE_SCHEMA_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshots = dict()
+        self._watchers = dict()
+
+    @staticmethod
+    def get_connection_key(mongo_conn):
+        return mongo_conn.get('host'), str(mongo_conn.get('port')), mongo_conn.get('username')
+
+    def get(self, mongo_conn, rule_name):
+        connection_key = self.get_connection_key(mongo_conn)
+        with self._lock:
+            snapshot = self._snapshots.get(connection_key)
+        if snapshot is None or (self.ttl is not None and time.monotonic() - snapshot[0] > self.ttl):
+            snapshot = self.load(mongo_conn)
+        return deepcopy(snapshot[1].get(rule_name, {}))
+
+    def load(self, mongo_conn):
+        schemas = dict()
+        for schema in get_result_from_mongo(mongo_conn, cs_policy_storage["database"],
+                                            cs_policy_storage["collection"], [{"$match": {"name": {"$ne": None}}}]):
+            schemas.setdefault(schema['name'], schema)
+        snapshot = (time.monotonic(), schemas)
+        with self._lock:
+            self._snapshots[self.get_connection_key(mongo_conn)] = snapshot
+        return snapshot
+
+    def invalidate(self, mongo_conn=None):
+        with self._lock:
+            if mongo_conn is None:
+                self._snapshots.clear()
+            else:
+                self._snapshots.pop(self.get_connection_key(mongo_conn), None)
+
+    def watch(self, mongo_conn):
+        """Invalidates the snapshot of `mongo_conn` on every change of the collection (needs a replica set)"""
+        connection_key = self.get_connection_key(mongo_conn)
+        with self._lock:
+            if connection_key in self._watchers and self._watchers[connection_key].is_alive():
+                return self._watchers[connection_key]
+            watcher = threading.Thread(target=self._watch_changes, args=(mongo_conn,), daemon=True)
+            self._watchers[connection_key] = watcher
+        watcher.start()
+        return watcher
+
+    def _watch_changes(self, mongo_conn):
+        try:
+            collection = get_mongo_client(mongo_conn)[cs_policy_storage["database"]][cs_policy_storage["collection"]]
+            with collection.watch() as change_stream:
+                for _ in change_stream:
+                    self.invalidate(mongo_conn)
+        except Exception:
+            # Change streams are unavailable on standalone servers, the TTL still bounds staleness
+            pass
+        finally:
+            # Anything missed while the stream was down must be reloaded
+            self.invalidate(mongo_conn)
+
+
+engine_schema_cache = EngineSchemaCache()
+
+
+def get_coded_engine_schema(content, policy_type):
+    registry = engine_schema_registries[policy_type]
+    if policy_type == 'managed':
+        return registry.get_by_name(content['RuleName'])
+    if content['QuerySource'] == ConnectorEngines.mongodb:
+        return registry.get_by_query_source(content['QuerySource'], content['QuerySourceIdentifier'])
+    return registry.get_by_query_source_identifiers(content['QuerySource'], get_query_tables(content['Query']))
+
+
 def get_engine_schema(content, mongo_conn):
-    if not content.get('QuerySource'):
-        policy_type = 'managed'
-        schema_expression = "list($.where($.name = '%s'))[0]" % content['RuleName']
-    else:
-        policy_type = 'custom'
-        if content['QuerySource'] == ConnectorEngines.mongodb:
-            schema_expression = "list($.where($.query_source = '%s' and $.query_source_identifier = '%s'))[0]" % (
-                content['QuerySource'], content['QuerySourceIdentifier'])
-        else:
-            table_names = get_query_tables(content['Query'])
-            schema_expression = "list($.where($.query_source = '%s' and $.query_source_identifier in %s))" % (
-                content['QuerySource'], json.dumps(table_names))
-    db_engine_schema = get_result_from_mongo(
-        mongo_conn, cs_policy_storage["database"], cs_policy_storage["collection"],
-        [{"$match": {"name": content['RuleName']}}])
-    schema_found = db_engine_schema[0] if db_engine_schema else {}
+    policy_type = 'custom' if content.get('QuerySource') else 'managed'
+    schema_found = engine_schema_cache.get(mongo_conn, content['RuleName'])
     if not schema_found:
-        engine_schema_path = os.path.join(
-            os.path.abspath(os.path.dirname(__file__)), 'data', '%s.json' % policy_type)
-        with open(engine_schema_path) as f:
-            coded_engine_schema = json.loads(f.read())
-        schema_found = yaql.eval(schema_expression, coded_engine_schema)
+        schema_found = get_coded_engine_schema(content, policy_type)
     return policy_type, schema_found
 
 
-def call_sql_asyn(connection_args, command):
-    # FIXME: Python3 Upgrade
-    # recv_end, send_end = multiprocessing.Pipe(False)
-    # p = multiprocessing.Process(target=execute_query, args=(connection_args, command, send_end))
-    # p.start()
-    # end_time = datetime.utcnow() + timedelta(minutes=5)
-    # while datetime.utcnow() < end_time:
-    #     if not p.is_alive():
-    #         p.join()
-    #         result = recv_end.recv()
-    #         break
-    #     time.sleep(30)
-    # else:
-    #     result = recv_end.recv()
-    #     p.join()
-    result = execute_query(connection_args, command)
-    if not result['status']:
-        raise Exception(result['message'])
-    return result['data']
+SQL_COMMAND_TIMEOUT = 300
+SQL_COMMAND_WORKERS = 20
 
+_sql_command_pools_lock = threading.Lock()
+_sql_command_pools = dict()
 
-def get_result_from_sql(connection_args, command, send_end):
+
+def get_sql_command_pool():
+    with _sql_command_pools_lock:
+        pool = _sql_command_pools.get(os.getpid())
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=SQL_COMMAND_WORKERS, thread_name_prefix='sql-command')
+            _sql_command_pools[os.getpid()] = pool
+    return pool
+
+
+class SqlCommand(object):
+    """SQL command running in the background, created with `submit_sql`
+
+    The command goes through the `execute_url` proxy when configured, otherwise directly through pyodbc.
+    `result()` waits until the deadline and cancels the command when it is reached. A pyodbc statement is
+    cancelled on the server; a proxy request is abandoned and its read timeout is bounded by the deadline.
+    """
+
+    def __init__(self, connection_args, command, timeout=None, parameters=None):
+        self.connection_args = connection_args
+        self.command = command
+        self.parameters = parameters
+        self.timeout = timeout or connection_args.get('timeout') or SQL_COMMAND_TIMEOUT
+        self.deadline = time.monotonic() + self.timeout
+        self.cancelled = False
+        self._cursor = None
+        self._lock = threading.Lock()
+        self.future = get_sql_command_pool().submit(self._run)
+
+    def _run(self):
+        if self.cancelled:
+            raise Exception('SQL command cancelled.')
+        remaining = max(self.deadline - time.monotonic(), 1)
+        if self.connection_args.get('execute_url'):
+            command, _ = build_parameterized_command(self.command, self.parameters)
+            result = execute_query(dict(self.connection_args, timeout=remaining), command)
+            if not result['status']:
+                raise Exception(result['message'])
+            return result['data']
+        command, values = build_parameterized_command(self.command, self.parameters, bind=True)
+        return fetch_result_from_sql(dict(self.connection_args, timeout=int(remaining)), command, values,
+                                     on_cursor=self._set_cursor)
+
+    def _set_cursor(self, cursor):
+        with self._lock:
+            self._cursor = cursor
+            if self.cancelled and cursor is not None:
+                cursor.cancel()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            self.future.cancel()
+            if self._cursor is not None:
+                try:
+                    self._cursor.cancel()
+                except Exception:
+                    pass
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        try:
+            return self.future.result(timeout=max(self.deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            self.cancel()
+            raise Exception('SQL command timed out after %s seconds.' % self.timeout)
+
+
+def submit_sql(connection_args, command, timeout=None, parameters=None):
+    return SqlCommand(connection_args, command, timeout, parameters)
+
+
+def call_sql_asyn(connection_args, command, timeout=None, parameters=None):
+    return submit_sql(connection_args, command, timeout, parameters).result()
+
+
+SQL_ODBC_POOL_SIZE = 10
+SQL_FETCH_BATCH_SIZE = 1000
+
+
+def get_odbc_connection_string(connection_args):
+    driver = '{ODBC Driver 17 for SQL Server}'
+    connection_string = 'DRIVER=' + driver + ';SERVER=' + connection_args['server'] + \
+                        ';DATABASE=' + connection_args['database'] + ';UID=' + \
+                        connection_args['user'] + ';PWD=' + connection_args['password']
+    if connection_args.get('port'):
+        connection_string += ';PORT=%s' % connection_args['port']
+    return connection_string
+
+
+class OdbcConnectionPool(object):
+    """Idle pyodbc connections kept open per connection string (pyodbc.pooling stays off, this is the pool)"""
+
+    def __init__(self, connection_string, max_size=SQL_ODBC_POOL_SIZE):
+        self.connection_string = connection_string
+        self.max_size = max_size
+        self._idle = list()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        return conn or pyodbc.connect(self.connection_string, timeout=60)
+
+    def release(self, conn, reusable=True):
+        if reusable:
+            with self._lock:
+                if len(self._idle) < self.max_size:
+                    self._idle.append(conn)
+                    return
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, list()
+        for conn in idle:
+            self.release(conn, reusable=False)
+
+
+_odbc_pools_lock = threading.Lock()
+_odbc_pools = dict()
+
+
+def get_odbc_pool(connection_args):
+    pool_key = (os.getpid(), get_odbc_connection_string(connection_args))
+    with _odbc_pools_lock:
+        pool = _odbc_pools.get(pool_key)
+        if pool is None:
+            pool = OdbcConnectionPool(pool_key[1])
+            _odbc_pools[pool_key] = pool
+    return pool
+
+
+def close_odbc_pools():
+    with _odbc_pools_lock:
+        pools = [pool for pool_key, pool in _odbc_pools.items() if pool_key[0] == os.getpid()]
+        _odbc_pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+atexit.register(close_odbc_pools)
+
+
+def iter_result_from_sql(connection_args, command, values=None, batch_size=SQL_FETCH_BATCH_SIZE, on_cursor=None):
+    """Streams the rows of every result set of `command` as dicts, fetching `batch_size` rows at a time.
+
+    The pooled connection goes back to the pool once the rows are exhausted. If the caller stops early,
+    the statement is cancelled and the connection is discarded.
+    """
+    pool = get_odbc_pool(connection_args)
+    conn = pool.acquire()
+    reusable = False
     try:
-        driver = '{ODBC Driver 17 for SQL Server}'
-        connection_string = 'DRIVER=' + driver + ';SERVER=' + connection_args['server'] + \
-                            ';DATABASE=' + connection_args['database'] + ';UID=' + \
-                            connection_args['user'] + ';PWD=' + connection_args['password']
-        if connection_args.get('port'):
-            connection_string += ';PORT=%s' % connection_args['port']
-        with pyodbc.connect(connection_string, timeout=60) as conn:
-            conn.timeout = connection_args.get('timeout', 300)
-            with conn.cursor() as cursor:
-                rows = cursor.execute(command).fetchall()
-                columns = [column[0] for column in cursor.description]
-                result = list()
-                for row in rows:
-                    result.append(dict(zip(columns, row)))
-                while cursor.nextset():
-                    rows = cursor.fetchall()
+        conn.timeout = int(connection_args.get('timeout', 300))
+        cursor = conn.cursor()
+        if on_cursor:
+            on_cursor(cursor)
+        try:
+            cursor.execute(command, *(values or []))
+            while True:
+                if cursor.description:
                     columns = [column[0] for column in cursor.description]
-                    for row in rows:
-                        result.append(dict(zip(columns, row)))
-        send_end.send({"status": True, "data": result})
+                    rows = cursor.fetchmany(batch_size)
+                    while rows:
+                        for row in rows:
+                            yield dict(zip(columns, row))
+                        rows = cursor.fetchmany(batch_size)
+                if not cursor.nextset():
+                    break
+            conn.commit()
+            reusable = True
+        finally:
+            if on_cursor:
+                on_cursor(None)
+            if not reusable:
+                try:
+                    cursor.cancel()
+                except Exception:
+                    pass
+            cursor.close()
+    finally:
+        pool.release(conn, reusable)
+
+
+def fetch_result_from_sql(connection_args, command, values=None, on_cursor=None):
+    return list(iter_result_from_sql(connection_args, command, values, on_cursor=on_cursor))
+
+
+class SqlResultStream(object):
+    """Rows of a SQL command streamed from a pooled pyodbc connection, counted as they are yielded
+
+    Rows are fetched `batch_size` at a time and handed to `format_rows` (if given) one batch at a time, so
+    memory use depends on the batch size, not on the number of rows. With `total_count_row`, a trailing
+    `TotalResourceCount` row is not yielded, its value is in `evaluated_resources` once the stream is exhausted.
+    """
+
+    def __init__(self, connection_args, command, parameters=None, timeout=None, batch_size=SQL_FETCH_BATCH_SIZE,
+                 format_rows=None, total_count_row=False):
+        self.connection_args = connection_args
+        self.command = command
+        self.parameters = parameters
+        self.timeout = timeout or connection_args.get('timeout') or SQL_COMMAND_TIMEOUT
+        self.batch_size = batch_size
+        self.format_rows = format_rows
+        self.total_count_row = total_count_row
+        self.count = 0
+        self.evaluated_resources = 0
+
+    def __iter__(self):
+        command, values = build_parameterized_command(self.command, self.parameters, bind=True)
+        rows = iter_result_from_sql(dict(self.connection_args, timeout=max(int(self.timeout), 1)), command, values,
+                                    self.batch_size)
+        batch = list()
+        for row in rows:
+            batch.append(row)
+            if len(batch) > self.batch_size:
+                # The last row is held back, it may be the total count row
+                yield from self._emit(batch[:-1])
+                batch = batch[-1:]
+        if self.total_count_row and batch and "TotalResourceCount" in batch[-1]:
+            self.evaluated_resources = batch.pop()["TotalResourceCount"]
+        yield from self._emit(batch)
+
+    def _emit(self, rows):
+        if rows and self.format_rows:
+            rows = self.format_rows(rows)
+        for row in rows:
+            self.count += 1
+            yield row
+
+
+def iter_result_from_sql_command(connection_args, command, parameters=None, timeout=None,
+                                 batch_size=SQL_FETCH_BATCH_SIZE, format_rows=None, total_count_row=False):
+    return SqlResultStream(connection_args, command, parameters, timeout, batch_size, format_rows, total_count_row)
+
+
+def get_result_from_sql(connection_args, command, send_end):
+    try:
+        send_end.send({"status": True, "data": fetch_result_from_sql(connection_args, command)})
     except Exception as e:
         send_end.send({"status": False, "message": str(e)})
     send_end.close()
 
 
-def get_mongo_client(connection_args):
+RESOURCE_NAME_CHUNK_SIZE = 500
+RESOURCE_NAME_CACHE_TTL = 900
+RESOURCE_NAME_CACHE_SIZE = 100000
+
+
+class ResourceNameResolver(object):
+    """LRU/TTL cache of report.ServiceResourceInventory `ResourceID -> (ResourceName, Name)`
+
+    Lookups are deduplicated across every policy of the process and sent in chunks of
+    `RESOURCE_NAME_CHUNK_SIZE` ids. IDs missing from the inventory are cached as well.
+    """
+
+    def __init__(self, ttl=RESOURCE_NAME_CACHE_TTL, max_size=RESOURCE_NAME_CACHE_SIZE,
+                 chunk_size=RESOURCE_NAME_CHUNK_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._names = OrderedDict()
+
+    @staticmethod
+    def get_source_key(connection_args):
+        return connection_args.get('execute_url') or connection_args.get('server'), connection_args.get('database')
+
+    def resolve(self, connection_args, resource_ids, timeout=None):
+        """Returns {ResourceID: {"ResourceName": .., "Name": ..}} for the ids found in the inventory
+
+        :param timeout: seconds the lookups may take, the ids not looked up by then are left unresolved
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        source_key = self.get_source_key(connection_args)
+        resolved = dict()
+        missing = list()
+        now = time.monotonic()
+        with self._lock:
+            for resource_id in OrderedDict.fromkeys(resource_ids):
+                cached = self._names.get((source_key, resource_id))
+                if cached is None or now - cached[0] > self.ttl:
+                    missing.append(resource_id)
+                    continue
+                self._names.move_to_end((source_key, resource_id))
+                if cached[1]:
+                    resolved[resource_id] = cached[1]
+        for start in range(0, len(missing), self.chunk_size):
+            chunk = missing[start:start + self.chunk_size]
+            resource_name_query = "SELECT ResourceID, ResourceName, Name FROM report.ServiceResourceInventory " \
+                                  "WHERE ResourceID IN (%s);" % ', '.join(
+                                      ["'%s'" % str(elem).replace("'", "''") for elem in chunk])
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                break
+            try:
+                resource_name_ref = call_sql_asyn(connection_args, resource_name_query, remaining)
+            except Exception:
+                # Left unresolved and uncached, the next policy retries them
+                continue
+            found = dict()
+            for elem in resource_name_ref:
+                found.setdefault(elem['ResourceID'], {"ResourceName": elem['ResourceName'], "Name": elem.get('Name')})
+            resolved.update(found)
+            self._store(source_key, [(resource_id, found.get(resource_id)) for resource_id in chunk])
+        return resolved
+
+    def _store(self, source_key, names):
+        now = time.monotonic()
+        with self._lock:
+            for resource_id, name in names:
+                self._names[(source_key, resource_id)] = (now, name)
+                self._names.move_to_end((source_key, resource_id))
+            while len(self._names) > self.max_size:
+                self._names.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._names.clear()
+
+    def format_violations(self, connection_args, result, seen=None, timeout=None):
+        """Replaces ResourceId/ResourceName of violations with the inventory names (see `resource_id_format`)
+
+        :param seen: set of the ResourceIds already formatted, to deduplicate violations streamed in batches
+        :param timeout: seconds the name lookups may take, see `resolve`
+        """
+        resources = OrderedDict()
+        for violation in result:
+            resource_id = violation.get("ResourceId", '')
+            if resource_id and resource_id not in resources and not (seen is not None and resource_id in seen):
+                resources[resource_id] = violation
+        if seen is not None:
+            seen.update(resources)
+        output = list()
+        unresolved = list()
+        resolved = self.resolve(connection_args, resources.keys(), timeout) if resources else dict()
+        for resource_id, violation in resources.items():
+            name = resolved.get(resource_id)
+            if not name:
+                unresolved.append(violation)
+                continue
+            violation.update(ResourceId=name['ResourceName'])
+            if name.get('Name'):
+                violation.update(ResourceName=name['Name'])
+            output.append(violation)
+        return output + unresolved
+
+
+resource_name_resolver = ResourceNameResolver()
+
+
+SERVICE_ACCOUNT_REF_CACHE_TTL = 3600
+
+
+class ServiceAccountRefCache(object):
+    """Process wide cache of `service_account_id -> report.ServiceAccount.ServiceAccountID` per SQL source"""
+
+    def __init__(self, ttl=SERVICE_ACCOUNT_REF_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._refs = dict()
+
+    @staticmethod
+    def get_source_key(connection_args):
+        return connection_args.get('execute_url') or connection_args.get('server'), connection_args.get('database')
+
+    def get(self, connection_args, service_account_id):
+        with self._lock:
+            cached = self._refs.get((self.get_source_key(connection_args), service_account_id))
+        if cached is None or time.monotonic() - cached[0] > self.ttl:
+            return None
+        return cached[1]
+
+    def set(self, connection_args, service_account_id, service_account_ref):
+        with self._lock:
+            self._refs[(self.get_source_key(connection_args), service_account_id)] = (
+                time.monotonic(), service_account_ref)
+
+    def warm(self, connection_args, service_account_ids, chunk_size=RESOURCE_NAME_CHUNK_SIZE):
+        """Loads the references of many accounts, `chunk_size` accounts per query"""
+        service_account_ids = list(OrderedDict.fromkeys(service_account_ids))
+        for start in range(0, len(service_account_ids), chunk_size):
+            chunk = service_account_ids[start:start + chunk_size]
+            service_account_command = "SELECT ID, ServiceAccountID FROM report.ServiceAccount " \
+                                      "WHERE isDeleted=0 AND ID IN (%s);" % ', '.join(
+                                          ["'%s'" % str(elem).replace("'", "''") for elem in chunk])
+            for elem in call_sql_asyn(connection_args, service_account_command):
+                self.set(connection_args, elem['ID'], elem['ServiceAccountID'])
+
+    def invalidate(self, service_account_id=None):
+        with self._lock:
+            if service_account_id is None:
+                self._refs.clear()
+            else:
+                for key in [key for key in self._refs if key[1] == service_account_id]:
+                    self._refs.pop(key)
+
+
+service_account_ref_cache = ServiceAccountRefCache()
+
+
+MONGO_MAX_POOL_SIZE = 100
+
+_mongo_clients_lock = threading.Lock()
+_mongo_clients = dict()
+
+
+def get_mongo_uri(connection_args):
     if connection_args.get('username') and connection_args.get('password') and connection_args.get('auth_database'):
         uri = "mongodb://%s:%s@%s:%s/%s" % (
             connection_args['username'], quote_plus(connection_args['password']),
             connection_args['host'], connection_args['port'], connection_args['auth_database'])
     else:
         uri = "mongodb://%s:%s" % (connection_args['host'], connection_args['port'])
-    return MongoClient(uri)
+    return uri
+
+
+def get_mongo_client(connection_args, max_pool_size=None):
+    """Returns the MongoClient shared by every caller using the same connection args.
+
+    Clients are pooled per process (a forked worker builds its own) and must not be closed by callers,
+    use `close_mongo_clients` on shutdown instead.
+    """
+    max_pool_size = max_pool_size or MONGO_MAX_POOL_SIZE
+    client_key = (os.getpid(), get_mongo_uri(connection_args), max_pool_size)
+    with _mongo_clients_lock:
+        client = _mongo_clients.get(client_key)
+        if client is None:
+            client = MongoClient(client_key[1], maxPoolSize=max_pool_size)
+            _mongo_clients[client_key] = client
+    return client
+
+
+def close_mongo_clients():
+    with _mongo_clients_lock:
+        clients = [client for client_key, client in _mongo_clients.items() if client_key[0] == os.getpid()]
+        _mongo_clients.clear()
+    for client in clients:
+        client.close()
+
+
+atexit.register(close_mongo_clients)
 
 
 def get_result_from_mongo(connection_args, database_name, collection_name, aggregate_query):
     client = get_mongo_client(connection_args)
     cursor = client[database_name][collection_name].aggregate(aggregate_query, cursor={}, allowDiskUse=True)
-    result = [elem for elem in cursor]
-    client.close()
-    return result
+    return [elem for elem in cursor]
+
+
+INVENTORY_JOIN_BATCH_SIZE = 1000
+
+
+def join_inventory_documents(collection, rows, row_key, match_query, inventory_key='check_resource_element',
+                             batch_size=INVENTORY_JOIN_BATCH_SIZE, projection=None):
+    """Yields `(row, inventory document or None)` for every row, like a `find_one` per row would.
+
+    The documents of `batch_size` rows are fetched with a single `{inventory_key: {"$in": [...]}}` query
+    (combined with `match_query`), so the rows can come from another database than the inventory.
+    """
+    batch = list()
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield from join_inventory_batch(collection, batch, row_key, match_query, inventory_key, projection)
+            batch = list()
+    if batch:
+        yield from join_inventory_batch(collection, batch, row_key, match_query, inventory_key, projection)
+
+
+def join_inventory_batch(collection, batch, row_key, match_query, inventory_key, projection=None):
+    query = dict(match_query)
+    query[inventory_key] = {"$in": list({row[row_key] for row in batch})}
+    documents = dict()
+    for document in collection.find(query, projection):
+        documents.setdefault(AccessNestedDict(document).get(inventory_key), document)
+    for row in batch:
+        yield row, documents.get(row[row_key])
+
+
+# Output fields of the orphaned resource rules, in `$project` syntax ("$path", {"$ifNull": ["$path", default]}
+# or a constant)
+ORPHAN_OUTPUT_FIELDS = OrderedDict([
+    ("Resource", "$resource"),
+    ("ResourceType", "$resource_type"),
+    ("ResourceId", "$check_resource_element"),
+    ("Region", "$location"),
+    ("ServiceAccountId", "$service_account_id"),
+    ("ResourceName", "$summary_details.name"),
+    ("ResourceCategory", "$category")
+])
+
+
+def get_document_values(document, path):
+    """Values of a dotted `path` in a document, array elements flattened the way `distinct` does"""
+    values = [document]
+    for key in path.split('.'):
+        next_values = list()
+        for value in values:
+            if isinstance(value, list):
+                next_values.extend(item.get(key) for item in value if isinstance(item, dict))
+            elif isinstance(value, dict):
+                next_values.append(value.get(key))
+        values = next_values
+    flattened = list()
+    for value in values:
+        if isinstance(value, list):
+            flattened.extend(value)
+        elif value is not None:
+            flattened.append(value)
+    return flattened
+
+
+def get_field_path(field):
+    """Document path of an output field: "$path" or {"$ifNull": ["$path", default]}, None for a constant"""
+    if isinstance(field, dict) and '$ifNull' in field:
+        field = field['$ifNull'][0]
+    if isinstance(field, str) and field.startswith('$'):
+        return field[1:]
+    return None
+
+
+def project_document(document, output_fields):
+    """Applies `output_fields` like `$project` would: missing "$path" fields are left out, `$ifNull` fields
+    always get a value"""
+    projected = OrderedDict()
+    for name, field in output_fields.items():
+        path = get_field_path(field)
+        if path is None:
+            projected[name] = field
+            continue
+        value = document
+        for key in path.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        if isinstance(field, dict):
+            projected[name] = field['$ifNull'][1] if value is None else value
+        elif value is not None:
+            projected[name] = value
+    return projected
+
+
+def find_orphaned_resources(collection, parent_query, parent_key, child_query, child_key='check_resource_element',
+                            output_fields=None, ignore_case=False):
+    """Returns `(orphaned children, evaluated children)` of a parent/child inventory relation
+
+    The parent references (`parent_key` of the `parent_query` documents) are loaded once into a set, the children
+    are then streamed once with a projection of the output fields: a child is orphaned when none of its
+    `child_key` values is a parent reference (or it has none), and every streamed child counts as evaluated.
+
+    :param output_fields: output document in `$project` syntax, defaults to `ORPHAN_OUTPUT_FIELDS`
+    :param ignore_case: compare the references case-insensitively
+    """
+    output_fields = output_fields or ORPHAN_OUTPUT_FIELDS
+    normalize = (lambda value: str(value).lower()) if ignore_case else (lambda value: value)
+    parent_references = set()
+    for document in collection.find(parent_query, {parent_key: 1, "_id": 0}):
+        parent_references.update(normalize(value) for value in get_document_values(document, parent_key))
+    projection = {get_field_path(field): 1 for field in output_fields.values() if get_field_path(field)}
+    projection.update({child_key: 1, "_id": 0})
+    orphaned, evaluated_resources = list(), 0
+    for document in collection.find(child_query, projection):
+        evaluated_resources += 1
+        if not any(normalize(value) in parent_references for value in get_document_values(document, child_key)):
+            orphaned.append(project_document(document, output_fields))
+    return orphaned, evaluated_resources
+
+
+INVENTORY_FRESHNESS_TTL = 300
+INVENTORY_MAX_AGE = timedelta(hours=24)
+# Discovery configuration of an account whose last inventory (buckets) sync succeeded
+INVENTORY_SYNC_QUERY = {"is_deleted": False, "rediscover_status": "completed", "is_active": True,
+                        "data_sync.status": "success", "overall_status": "completed",
+                        "data_sync.message": "Completed buckets sync"}
+
+
+class InventoryFreshness(object):
+    """Process wide cache of the last successful inventory sync (`data_sync.completed_at`) per account
+
+    The discovery configuration is queried once per account and Mongo connection, then kept for `ttl` seconds,
+    so every inventory backed rule of a run shares one lookup. Rules can compare `get_last_sync` with their
+    own staleness limit to choose between the inventory and the live API.
+    """
+
+    database_name = 'resource_inventory'
+    collection_name = 'service_inventory_dependency_configuration'
+    sort_field = 'data_sync.completed_at'
+
+    def __init__(self, ttl=INVENTORY_FRESHNESS_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_syncs = dict()
+
+    def get_last_sync(self, connection_args, service_account_id):
+        """`datetime` (UTC) of the last successful inventory sync of the account, None if it never completed"""
+        sync_key = (get_mongo_uri(connection_args), service_account_id)
+        with self._lock:
+            cached = self._last_syncs.get(sync_key)
+        if cached is not None and time.monotonic() - cached[0] <= self.ttl:
+            return cached[1]
+        query = dict(INVENTORY_SYNC_QUERY, service_account_id=service_account_id)
+        account_details = get_mongo_client(connection_args)[self.database_name][self.collection_name].find_one(
+            query, {self.sort_field: 1, "_id": 0}, sort=[(self.sort_field, -1)])
+        last_sync = (account_details or {}).get('data_sync', {}).get('completed_at')
+        with self._lock:
+            self._last_syncs[sync_key] = (time.monotonic(), last_sync)
+        return last_sync
+
+    def is_fresh(self, connection_args, service_account_id, max_age=INVENTORY_MAX_AGE):
+        last_sync = self.get_last_sync(connection_args, service_account_id)
+        return last_sync is not None and last_sync > datetime.utcnow() - max_age
+
+    def invalidate(self, service_account_id=None):
+        with self._lock:
+            if service_account_id is None:
+                self._last_syncs.clear()
+            else:
+                for key in [key for key in self._last_syncs if key[1] == service_account_id]:
+                    self._last_syncs.pop(key)
+
+
+inventory_freshness = InventoryFreshness()
+
+
+MONGO_STREAM_BATCH_SIZE = 1000
+
+
+class MongoResultStream(object):
+    """Documents of an aggregation fetched `batch_size` at a time, counted as they are yielded
+
+    `projection`, when given, is pushed into the pipeline as a final `$project` stage so only the output
+    fields leave the server. Memory use depends on the batch size, not on the number of documents.
+    """
+
+    def __init__(self, connection_args, database_name, collection_name, aggregate_query,
+                 batch_size=MONGO_STREAM_BATCH_SIZE, projection=None):
+        self.connection_args = connection_args
+        self.database_name = database_name
+        self.collection_name = collection_name
+        self.aggregate_query = list(aggregate_query)
+        if projection:
+            self.aggregate_query.append({"$project": projection})
+        self.batch_size = batch_size
+        self.count = 0
+
+    def __iter__(self):
+        collection = get_mongo_client(self.connection_args)[self.database_name][self.collection_name]
+        with collection.aggregate(self.aggregate_query, allowDiskUse=True, batchSize=self.batch_size) as cursor:
+            for elem in cursor:
+                self.count += 1
+                yield elem
+
+
+def iter_result_from_mongo(connection_args, database_name, collection_name, aggregate_query,
+                           batch_size=MONGO_STREAM_BATCH_SIZE, projection=None):
+    return MongoResultStream(connection_args, database_name, collection_name, aggregate_query, batch_size,
+                             projection)
 
 
 def get_execution_parameter_required(engine_schema, execution_args, command_args_list):
@@ -133,6 +874,66 @@ def get_execution_parameter_required(engine_schema, execution_args, command_args
     return command_args_list
 
 
+def get_execution_parameters_required(engine_schema, execution_args, parameters):
+    """Same parameters as `get_execution_parameter_required`, as values for a parameterized command"""
+    if engine_schema.get("resource_type_ref"):
+        parameters[engine_schema['resource_type_ref']] = execution_args.get("resource_type")
+    if engine_schema.get("resource_ref"):
+        parameters[engine_schema['resource_ref']] = execution_args.get("resource")
+    if engine_schema.get("assessment_ref") and execution_args.get("IsAssessment"):
+        parameters[engine_schema['assessment_ref']] = execution_args.get("IsAssessment")
+    if engine_schema.get("AttributesSupported") and execution_args.get('ResourceProperties', []):
+        parameters['Attributes'] = ','.join(execution_args['ResourceProperties'])
+    return parameters
+
+
+SQL_NVARCHAR_MAX_LENGTH = 4000
+
+
+def get_sql_type(value):
+    if isinstance(value, bool):
+        return 'bit'
+    if isinstance(value, int):
+        return 'bigint'
+    if isinstance(value, float):
+        return 'float'
+    # A bounded type keeps index seeks possible, MAX is only needed for longer values
+    if value is not None and len(str(value)) > SQL_NVARCHAR_MAX_LENGTH:
+        return 'nvarchar(max)'
+    return 'nvarchar(%s)' % SQL_NVARCHAR_MAX_LENGTH
+
+
+def to_sql_literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "N'%s'" % str(value).replace("'", "''")
+
+
+def build_parameterized_command(statement, parameters, bind=False):
+    """Wraps `statement` (using `@name` placeholders) in sp_executesql so its text, and therefore its cached
+    plan, is the same whatever the parameter values are.
+
+    :param parameters: OrderedDict of parameter name (without @) to value
+    :param bind: render `?` markers for the values, to pass them as ODBC parameters, instead of literals
+    :return: (command, ODBC parameter values)
+    """
+    if not parameters:
+        return statement, list()
+    definitions = ', '.join('@%s %s' % (name, get_sql_type(value)) for name, value in parameters.items())
+    if bind:
+        assignments = ', '.join('@%s=?' % name for name in parameters)
+        values = [int(value) if isinstance(value, bool) else value for value in parameters.values()]
+    else:
+        assignments = ', '.join('@%s=%s' % (name, to_sql_literal(value)) for name, value in parameters.items())
+        values = list()
+    command = "EXEC sp_executesql %s, N'%s', %s;" % (to_sql_literal(statement), definitions, assignments)
+    return command, values
+
+
 def datetime_parser(dct):
     for k, v in dct.items():
         if isinstance(v, str) and re.search(r"^\d{4}-(0[1-9]|1[012])-(0[1-9]|[12]\d|3[01])$", v):
@@ -143,15 +944,160 @@ def datetime_parser(dct):
     return dct
 
 
+MONGO_QUERY_TEMPLATE_CACHE_SIZE = 1024
+VALUE_SLOT_MARKER = '\x01'
+STRING_SLOT_MARKER = '\x00'
+
+_mongo_query_templates_lock = threading.Lock()
+_mongo_query_templates = OrderedDict()
+
+
+class MongoQueryTemplate(object):
+    """Aggregation pipeline of a MongoDB policy, parsed once and bound per execution
+
+    `{Param}` placeholders become slots of the parsed pipeline: value slots where the placeholder stands for a
+    JSON value, string slots where it is part of a string (field names such as `tags.{TagName}`). Static date
+    strings are converted once at parse time. `bind` only copies the structure and fills the slots, giving the
+    same pipeline as substituting the text and parsing it with `datetime_parser`.
+    """
+
+    def __init__(self, query, input_parameters):
+        self.query = query
+        self.raw_parameters = {name for name, config in input_parameters.items() if config.get('query_field')}
+        placeholder = re.compile(r'{(%s)}' % '|'.join(re.escape(name) for name in input_parameters) or r'(?!)')
+        text = list()
+        in_string = escaped = False
+        position = 0
+        while position < len(query):
+            char = query[position]
+            match = placeholder.match(query, position) if char == '{' else None
+            if match:
+                if in_string:
+                    text.append('\\u0000%s\\u0000' % match.group(1))
+                else:
+                    text.append('"\\u0001%s"' % match.group(1))
+                position = match.end()
+                continue
+            if in_string and escaped:
+                escaped = False
+            elif in_string and char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = not in_string
+            text.append(char)
+            position += 1
+        self.pipeline = json.loads(''.join(text), object_hook=datetime_parser)
+
+    def bind(self, args):
+        return self._bind(self.pipeline, args, False)
+
+    def _bind(self, node, args, is_dict_value):
+        if isinstance(node, dict):
+            return {self._bind_string(key, args) if STRING_SLOT_MARKER in key else key:
+                    self._bind(value, args, True) for key, value in node.items()}
+        if isinstance(node, list):
+            return [self._bind(value, args, False) for value in node]
+        if not isinstance(node, str):
+            return node
+        if node.startswith(VALUE_SLOT_MARKER):
+            value = self._bind_value(node[1:], args)
+        elif STRING_SLOT_MARKER in node:
+            value = self._bind_string(node, args)
+        else:
+            return node
+        if is_dict_value and isinstance(value, str):
+            value = datetime_parser({'value': value})['value']
+        return value
+
+    def _get_arg_text(self, name, args):
+        value = args[name]
+        if isinstance(value, str) and name in self.raw_parameters:
+            return value
+        return json.dumps(value)
+
+    def _bind_value(self, name, args):
+        if name not in args:
+            raise ValueError('Missing value for query parameter {%s}' % name)
+        return json.loads(self._get_arg_text(name, args), object_hook=datetime_parser)
+
+    def _bind_string(self, text, args):
+        return re.sub('%s(\\w+)%s' % (STRING_SLOT_MARKER, STRING_SLOT_MARKER),
+                      lambda match: self._get_arg_text(match.group(1), args) if match.group(1) in args
+                      else '{%s}' % match.group(1), text)
+
+
+def get_mongo_query_template(query, input_parameters):
+    template_key = (query, tuple(sorted((name, bool(config.get('query_field')))
+                                        for name, config in input_parameters.items())))
+    with _mongo_query_templates_lock:
+        template = _mongo_query_templates.get(template_key)
+        if template is not None:
+            _mongo_query_templates.move_to_end(template_key)
+            return template
+    template = MongoQueryTemplate(query, input_parameters)
+    with _mongo_query_templates_lock:
+        _mongo_query_templates[template_key] = template
+        while len(_mongo_query_templates) > MONGO_QUERY_TEMPLATE_CACHE_SIZE:
+            _mongo_query_templates.popitem(last=False)
+    return template
+
+
+SQL_PROXY_POOL_SIZE = 20
+SQL_PROXY_CONNECT_TIMEOUT = 10
+SQL_PROXY_READ_TIMEOUT = 300
+SQL_PROXY_RETRIES = 3
+# Retries of a 503 from the proxy, only safe to raise for a proxy which never runs a rejected command
+SQL_PROXY_STATUS_RETRIES = 0
+
+_sql_proxy_sessions_lock = threading.Lock()
+_sql_proxy_sessions = dict()
+
+
+def get_sql_proxy_session(connection_args):
+    """Keep-alive HTTP session for the SQL `execute_url` proxy, shared per (process, url, user)"""
+    session_key = (os.getpid(), connection_args['execute_url'], connection_args['auth_user'],
+                   connection_args['auth_password'])
+    with _sql_proxy_sessions_lock:
+        session = _sql_proxy_sessions.get(session_key)
+        if session is None:
+            session = requests.Session()
+            # Only connection failures are retried, the proxy never received the command. A 502/504 means the
+            # command was forwarded and may still be running, replaying it would start it again
+            retries = Retry(total=SQL_PROXY_RETRIES, connect=SQL_PROXY_RETRIES, read=0,
+                            status=SQL_PROXY_STATUS_RETRIES, status_forcelist=(503,),
+                            allowed_methods=frozenset({'POST'}), backoff_factor=0.5, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=SQL_PROXY_POOL_SIZE, pool_maxsize=SQL_PROXY_POOL_SIZE,
+                                  max_retries=retries)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            user_and_pass = b64encode((connection_args['auth_user'] + ":" +
+                                       connection_args['auth_password']).encode()).decode("ascii")
+            session.headers.update({'Authorization': 'Basic %s' % user_and_pass,
+                                    'Content-Type': 'application/json',
+                                    'Accept-Encoding': 'gzip, deflate',
+                                    'Connection': 'keep-alive'})
+            session.verify = False
+            _sql_proxy_sessions[session_key] = session
+    return session
+
+
+def close_sql_proxy_sessions():
+    with _sql_proxy_sessions_lock:
+        sessions = list(_sql_proxy_sessions.values())
+        _sql_proxy_sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+atexit.register(close_sql_proxy_sessions)
+
+
 def execute_query(connection_args, command, send_end=None):
     try:
         request_body = {"command": command}
-        api_url = connection_args['execute_url']
-        user = connection_args['auth_user']
-        password = connection_args['auth_password']
-        userAndPass = b64encode((user + ":" + password).encode()).decode("ascii")
-        headers = {'Authorization': 'Basic %s' % userAndPass, 'Content-Type': 'application/json'}
-        response = requests.post(api_url, headers=headers, json=request_body, verify=False)
+        session = get_sql_proxy_session(connection_args)
+        timeout = (SQL_PROXY_CONNECT_TIMEOUT, connection_args.get('timeout') or SQL_PROXY_READ_TIMEOUT)
+        response = session.post(connection_args['execute_url'], json=request_body, timeout=timeout)
         if response.status_code == 200:
             data = {"status": True, "data": response.json()}
         else: